@@ -0,0 +1,108 @@
+'''
+Stress test for sessions that share the corpus index and RerankAlgos.LLM.params. Runs
+NUMBER_OF_SESSIONS sessions in parallel threads, half with one PipelineConfig and half with another (a different
+chat model and openai client, as for two api keys), each asking TURNS_PER_SESSION questions with the LLM rerank.
+
+It checks that
+- every search returns the same definitions and sections as the same question asked serially
+- every rerank request went to the client of the session's own PipelineConfig with its chat model
+- a session's write to RerankAlgos.LLM.params is not seen by any other session
+
+OpenAI is replaced by the local stub server from retrieval_latency.py.
+
+Needs the index and its key: DECRYPTION_KEY_CEMAD must be set (e.g. in .env).
+Run from the root of the repository: python benchmarks/concurrent_sessions.py
+'''
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI, DefaultHttpxClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from regulations_rag.corpus_chat import ChatParameters
+from regulations_rag.embeddings import EmbeddingParameters
+from regulations_rag.rerank import RerankAlgos
+from cemad_rag.cemad_corpus_index import CEMADCorpusIndex
+from cemad_rag.corpus_chat_cemad import CorpusChatCEMAD
+from cemad_rag.embedding_cache import EmbeddingCache, CachedEmbeddingsClient
+from cemad_rag.pipeline_config import PipelineConfig, use_pipeline_config
+from retrieval_latency import StubOpenAI
+import retrieval_latency
+
+NUMBER_OF_SESSIONS = 32
+TURNS_PER_SESSION = 10
+NUMBER_OF_QUESTIONS = 40
+CHAT_MODELS = {"key_a": "gpt-4o", "key_b": "gpt-4o-mini"}
+
+
+def summarise(search_result):
+    workflow_triggered, relevant_definitions, relevant_sections = search_result
+    return str(workflow_triggered), tuple(relevant_definitions.index), tuple(relevant_sections.index)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    # the latency is not measured here, only the interleaving matters
+    retrieval_latency.EMBEDDING_LATENCY = (0.02, 0.5)
+    retrieval_latency.CHAT_LATENCY = (0.05, 0.5)
+    corpus_index = CEMADCorpusIndex(os.getenv("DECRYPTION_KEY_CEMAD"))
+    stub = StubOpenAI()
+    embedding_cache = EmbeddingCache()
+    pipeline_configs = {}
+    for api_key, chat_model in CHAT_MODELS.items():
+        # the api key is in the path so the stub can tell which client sent a request
+        openai_client = OpenAI(api_key = "stub", base_url = f"{stub.base_url}/{api_key}", http_client = DefaultHttpxClient(), max_retries = 0)
+        pipeline_configs[api_key] = PipelineConfig(openai_client = CachedEmbeddingsClient(openai_client, embedding_cache),
+                                                   chat_model = chat_model,
+                                                   user_type = corpus_index.user_type,
+                                                   corpus_description = corpus_index.corpus_description)
+    embedding_parameters = EmbeddingParameters("text-embedding-3-large", 1024)
+
+    index_embeddings = corpus_index.embedding_matrices["index"].exact_matrix
+    random_generator = np.random.default_rng(2)
+    questions = [f"question {i}" for i in range(NUMBER_OF_QUESTIONS)]
+    for question in questions:
+        stub.embeddings[question] = index_embeddings[random_generator.integers(len(index_embeddings))].astype(float).tolist()
+
+    def create_chat(api_key, user_name):
+        pipeline_config = pipeline_configs[api_key]
+        return CorpusChatCEMAD(embedding_parameters = embedding_parameters,
+                               chat_parameters = ChatParameters(chat_model = pipeline_config.chat_model, api_key = "stub", temperature = 0, max_tokens = 500, token_limit_when_truncating_message_queue = 3500),
+                               corpus_index = corpus_index,
+                               rerank_algo = RerankAlgos.LLM,
+                               user_name_for_logging = user_name,
+                               pipeline_config = pipeline_config)
+
+    chat = create_chat("key_a", "serial")
+    with use_pipeline_config(chat.pipeline_config):
+        serial = {question: summarise(chat.path_search.similarity_search(question)) for question in questions}
+
+    def run_session(session_number):
+        api_key = list(CHAT_MODELS)[session_number % len(CHAT_MODELS)]
+        chat = create_chat(api_key, f"session {session_number}")
+        mismatches = 0
+        with use_pipeline_config(chat.pipeline_config):
+            RerankAlgos.LLM.params["session"] = session_number
+            for turn in range(TURNS_PER_SESSION):
+                question = questions[(session_number * 7 + turn) % NUMBER_OF_QUESTIONS]
+                mismatches += summarise(chat.path_search.similarity_search(question)) != serial[question]
+            params_leaked = RerankAlgos.LLM.params["session"] != session_number
+        return mismatches, params_leaked
+
+    requests_before = len(stub.chat_requests)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = NUMBER_OF_SESSIONS) as sessions:
+        results = list(sessions.map(run_session, range(NUMBER_OF_SESSIONS)))
+    elapsed = time.perf_counter() - start
+
+    rerank_requests = stub.chat_requests[requests_before:]
+    wrong_model = [(path, model) for path, model in rerank_requests if model != CHAT_MODELS[path.split("/")[2]]]
+    print(f"{NUMBER_OF_SESSIONS} sessions x {TURNS_PER_SESSION} turns in {elapsed:.1f}s with {len(CHAT_MODELS)} PipelineConfigs")
+    print(f"    searches that differ from the serial run: {sum(mismatches for mismatches, _ in results)}")
+    print(f"    rerank requests with another session's config: {len(wrong_model)} of {len(rerank_requests)}")
+    print(f"    sessions that saw another session's params: {sum(params_leaked for _, params_leaked in results)}")
@@ -0,0 +1,62 @@
+'''
+Compares the quantized (float16 and int8) EmbeddingMatrix search with the full precision (float32) search on the
+unencrypted embedding tables. For each precision it prints the recall against float32, the time per query and the
+memory held for the search, with a threshold search (as used by the index) and a top 16 search (as used by the BOP
+code lookup).
+
+Some tables have rows with identical embeddings (bopcodes has 636 rows but 457 distinct embeddings) which tie, so
+the recall counts rows with the same embedding as the same match. The memory for the full precision DataFrame column (one Python object per embedding), which the quantized
+precisions drop, is printed separately.
+
+Run from the root of the repository: python benchmarks/quantized_embeddings.py
+'''
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cemad_rag.embedding_matrix import EmbeddingMatrix
+
+# (threshold, top_k)
+SEARCHES = [(0.45, None), (1.0, 16)]
+
+
+def get_queries(df, seed = 1):
+    ''' Noisy copies of rows, which have a close match, and noisy mixtures of two rows, which are near many rows '''
+    rng = np.random.default_rng(seed)
+    embeddings = [np.asarray(embedding) for embedding in df["embedding"]]
+    dimensions = len(embeddings[0])
+    queries = [embeddings[row] + rng.normal(0, 0.03, dimensions) for row in rng.integers(0, len(df), 200)]
+    queries += [0.5 * embeddings[first] + 0.5 * embeddings[second] + rng.normal(0, 0.01, dimensions) for first, second in rng.integers(0, len(df), (200, 2))]
+    return queries
+
+
+if __name__ == "__main__":
+    exact_store_folder = tempfile.mkdtemp()
+    for table_name in ["ad_definitions", "bopcodes"]:
+        df = pd.read_parquet(f"./inputs/index/{table_name}.parquet", engine = "pyarrow")
+        queries = get_queries(df)
+        embedding_column_bytes = sum(np.asarray(embedding).nbytes + sys.getsizeof(embedding) for embedding in df["embedding"])
+        print(f"{table_name}: {len(df)} rows, {len(queries)} queries. The embedding column holds {embedding_column_bytes / 1e6:.2f}MB as Python objects")
+
+        reference = EmbeddingMatrix(df)
+        # rows with the same embedding get the same id
+        _, embedding_ids = np.unique(reference.exact_matrix, axis = 0, return_inverse = True)
+        embedding_ids = embedding_ids.ravel()
+        for threshold, top_k in SEARCHES:
+            expected = [reference.get_closest_rows(query, threshold, top_k)[0] for query in queries]
+            for precision in EmbeddingMatrix.PRECISIONS:
+                embedding_matrix = EmbeddingMatrix(df, precision = precision, exact_store_folder = exact_store_folder)
+                start = time.perf_counter()
+                found = [embedding_matrix.get_closest_rows(query, threshold, top_k)[0] for query in queries]
+                query_time = (time.perf_counter() - start) / len(queries)
+                total = sum(len(rows) for rows in expected)
+                recalled = sum(sum((Counter(embedding_ids[a]) & Counter(embedding_ids[b])).values()) for a, b in zip(found, expected))
+                print(f"    threshold {threshold}, top_k {top_k}, {precision:8s}: recall {recalled / max(total, 1):.4f} of {total} matches, "
+                      f"{query_time * 1e6:.0f}us per query, {embedding_matrix.memory_usage() / 1e6:.2f}MB for the search")
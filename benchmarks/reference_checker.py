@@ -0,0 +1,82 @@
+'''
+Parses every section_reference in ad_manual.csv with regulations_rag's generic ReferenceChecker (configured with the
+CEMAD patterns) and with CEMADReferenceChecker, checks that is_valid, split_reference, get_parent_reference, the
+ancestor chain and extract_valid_reference agree and prints the time taken by each (best of REPEATS). "cold" is a
+new CEMADReferenceChecker, i.e. before anything is memoized.
+
+Run from the root of the repository: python benchmarks/reference_checker.py
+'''
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from regulations_rag.reference_checker import ReferenceChecker
+from cemad_rag.cemad_reference_checker import CEMADReferenceChecker
+
+REPEATS = 5
+
+
+def best_time(function, references, create_checker):
+    ''' The best of REPEATS runs of function(checker, reference) over references, with a checker from create_checker() for each run '''
+    times = []
+    for _ in range(REPEATS):
+        checker = create_checker()
+        start = time.perf_counter()
+        for reference in references:
+            function(checker, reference)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_ancestor_chain(checker, reference):
+    ''' What get_ancestors replaced: calling get_parent_reference until the root '''
+    ancestors = []
+    parent_reference = checker.get_parent_reference(reference)
+    while parent_reference != "":
+        ancestors.append(parent_reference)
+        parent_reference = checker.get_parent_reference(parent_reference)
+    return tuple(ancestors)
+
+
+def split_or_none(checker, reference):
+    return checker.split_reference(reference) if checker.is_valid(reference) else None
+
+
+if __name__ == "__main__":
+    document_as_df = pd.read_csv("./inputs/documents/ad_manual.csv", sep = "|", dtype = str, keep_default_na = False)
+    references = [reference for reference in document_as_df["section_reference"] if reference != ""]
+    texts = document_as_df["text"].to_list()
+    print(f"{len(references)} section references ({len(set(references))} distinct) and {len(texts)} texts in ad_manual.csv")
+
+    generic = ReferenceChecker(regex_list_of_indices = CEMADReferenceChecker.INDEX_PATTERNS,
+                               text_version = CEMADReferenceChecker.TEXT_PATTERN,
+                               exclusion_list = CEMADReferenceChecker.EXCLUSION_LIST)
+    checker = CEMADReferenceChecker()
+    comparisons = [("is_valid", lambda c, reference: c.is_valid(reference), references),
+                   ("split_reference", split_or_none, references),
+                   ("get_parent_reference", lambda c, reference: c.get_parent_reference(reference) if c.is_valid(reference) else None, references),
+                   ("extract_valid_reference", lambda c, text: c.extract_valid_reference(text), texts)]
+    for name, function, inputs in comparisons:
+        differences = [value for value in inputs if function(generic, value) != function(checker, value)]
+        print(f"{name}: {'identical' if not differences else f'{len(differences)} differences, e.g. {differences[:3]}'}")
+    valid_references = [reference for reference in references if generic.is_valid(reference)]
+    differences = [reference for reference in valid_references if get_ancestor_chain(generic, reference) != checker.get_ancestors(reference)]
+    print(f"get_ancestors: {'identical' if not differences else f'{len(differences)} differences, e.g. {differences[:3]}'}")
+
+    print("milliseconds, best of", REPEATS)
+    create_generic = lambda: generic
+    memoized = CEMADReferenceChecker()
+    create_memoized = lambda: memoized
+    timings = [("is_valid", lambda c, reference: c.is_valid(reference), references),
+               ("get_parent_reference", lambda c, reference: c.get_parent_reference(reference), valid_references)]
+    for name, function, inputs in timings:
+        print(f"    {name:<22} generic {best_time(function, inputs, create_generic) * 1e3:7.2f}   "
+              f"cold {best_time(function, inputs, CEMADReferenceChecker) * 1e3:7.2f}   "
+              f"memoized {best_time(function, inputs, create_memoized) * 1e3:7.2f}")
+    print(f"    {'ancestor chain':<22} generic {best_time(get_ancestor_chain, valid_references, create_generic) * 1e3:7.2f}   "
+          f"cold {best_time(lambda c, reference: c.get_ancestors(reference), valid_references, CEMADReferenceChecker) * 1e3:7.2f}   "
+          f"memoized {best_time(lambda c, reference: c.get_ancestors(reference), valid_references, create_memoized) * 1e3:7.2f}")
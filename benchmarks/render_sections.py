@@ -0,0 +1,96 @@
+'''
+Renders every section of the CEMAD documents with SectionRenderer (via get_text) and with the original iterrows
+implementation, checks that the text is identical and prints the time taken by each.
+
+Run from the root of the repository: python benchmarks/render_sections.py
+'''
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cemad_rag.documents.cemad import CEMAD
+from cemad_rag.documents.cemad_user_queries import CEMAD_User_Queries
+
+
+def iterrows_get_text(document_as_df, reference_checker, section_reference, add_markdown_decorators = True):
+    ''' The get_text implementation SectionRenderer replaced, kept here as the reference for the output and the timing '''
+    space = " "
+    line_end = "\n"
+    if add_markdown_decorators:
+        space = '&nbsp;'
+        line_end = "\n\n"
+
+    text = ''
+    terminal_text_df = document_as_df[document_as_df['section_reference'].str.startswith(section_reference)]
+    if len(terminal_text_df) == 0:
+        return f"No section could be found with the reference {section_reference}"
+    terminal_text_index = terminal_text_df.index[0]
+    terminal_text_indent = 0
+    for index, row in terminal_text_df.iterrows():
+        number_of_spaces = (row['indent'] - terminal_text_indent) * 4
+        line = space * number_of_spaces
+        if pd.isna(row['reference']) or row['reference'] == '':
+            line = line + row['text']
+        else:
+            if pd.isna(row['text']):
+                line = line + row['reference']
+            else:
+                line = line + row['reference'] + " " + row['text']
+        if text != "":
+            text = text + line_end
+        text = text + line
+
+    if section_reference != '':
+        parent_reference = reference_checker.get_parent_reference(section_reference)
+        all_conditions = ""
+        all_qualifiers = ""
+        while parent_reference != "":
+            parent_text_df = document_as_df[document_as_df['section_reference'] == parent_reference]
+            conditions = ""
+            qualifiers = ""
+            for index, row in parent_text_df.iterrows():
+                number_of_spaces = (row['indent'] - terminal_text_indent) * 4
+                line = row['text'] if row['reference'] == '' else row['reference'] + " " + row['text']
+                if index < terminal_text_index:
+                    if conditions != "":
+                        conditions = conditions + line_end
+                    conditions = conditions + space * number_of_spaces + line
+                else:
+                    if qualifiers != "":
+                        qualifiers = qualifiers + line_end
+                    qualifiers = qualifiers + space * number_of_spaces + line
+            if conditions != "":
+                all_conditions = conditions + line_end + all_conditions
+            if qualifiers != "":
+                all_qualifiers = all_qualifiers + line_end + qualifiers
+            parent_reference = reference_checker.get_parent_reference(parent_reference)
+
+        if all_conditions != "":
+            text = all_conditions + text
+        if all_qualifiers != "":
+            text = text + all_qualifiers
+
+    return text
+
+
+if __name__ == "__main__":
+    for document in [CEMAD(), CEMAD_User_Queries()]:
+        section_references = list(dict.fromkeys(document.document_as_df["section_reference"]))
+        calls = [(section_reference, add_markdown_decorators) for section_reference in section_references for add_markdown_decorators in [True, False]]
+
+        start = time.perf_counter()
+        original = [iterrows_get_text(document.document_as_df, document.reference_checker, section_reference, add_markdown_decorators) for section_reference, add_markdown_decorators in calls]
+        original_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rendered = [document.get_text(section_reference, add_markdown_decorators) for section_reference, add_markdown_decorators in calls]
+        rendered_time = time.perf_counter() - start
+
+        differences = [call for call, a, b in zip(calls, original, rendered) if a != b]
+        print(f"{type(document).__name__}: {len(calls)} renders (every section, plain and markdown). "
+              f"iterrows {original_time:.3f}s, SectionRenderer {rendered_time:.3f}s ({original_time / rendered_time:.0f}x). "
+              f"{'Identical' if not differences else f'{len(differences)} differences, e.g. {differences[:3]}'}")
@@ -0,0 +1,135 @@
+'''
+Measures the p50 / p95 latency of the retrieval part of a turn (PathSearchCEMAD.similarity_search: embedding,
+workflow check, definitions and sections searches and the LLM rerank) and counts the rerank (chat) calls.
+
+OpenAI is replaced by a local stub server that sleeps for a log-normal time before it answers, so the numbers do
+not depend on the network. The stub answers a section question with the embedding of an index row and a workflow
+question (WORKFLOW_SHARE of the turns) with the sum of the embeddings of a workflow and an index row, so both paths
+through PathSearch are measured. The turns are reported by the path they took (i.e. whether a workflow was
+triggered). A workflow turn should make no rerank call.
+
+Needs the index and its key: DECRYPTION_KEY_CEMAD must be set (e.g. in .env).
+Run from the root of the repository: python benchmarks/retrieval_latency.py
+'''
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI, DefaultHttpxClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from regulations_rag.corpus_chat import ChatParameters
+from regulations_rag.embeddings import EmbeddingParameters
+from regulations_rag.rerank import RerankAlgos
+from cemad_rag.cemad_corpus_index import CEMADCorpusIndex
+from cemad_rag.corpus_chat_cemad import CorpusChatCEMAD
+from cemad_rag.embedding_cache import EmbeddingCache, CachedEmbeddingsClient
+from cemad_rag.pipeline_config import PipelineConfig, use_pipeline_config
+
+NUMBER_OF_TURNS = 80
+WORKFLOW_SHARE = 0.25
+# median seconds and log-normal sigma of the stub's answers
+EMBEDDING_LATENCY = (0.15, 0.3)
+CHAT_LATENCY = (0.7, 0.3)
+STUB_RERANK_REPLY = "[]"
+
+
+class StubOpenAI:
+    ''' A local stand in for the embeddings and chat completions endpoints '''
+    def __init__(self, seed = 0):
+        self.embeddings = {}    # question -> embedding it is answered with
+        self.chat_calls = 0
+        self.chat_requests = [] # (path, model) of each chat request
+        self._random_generator = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path.endswith("/embeddings"):
+                    stub._sleep(EMBEDDING_LATENCY)
+                    data = [{"object": "embedding", "index": i, "embedding": stub.embeddings[text]} for i, text in enumerate(request["input"])]
+                    response = {"object": "list", "data": data, "model": request["model"], "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+                else:
+                    with stub._lock:
+                        stub.chat_calls += 1
+                        stub.chat_requests.append((self.path, request["model"]))
+                    stub._sleep(CHAT_LATENCY)
+                    response = {"id": "stub", "object": "chat.completion", "created": 0, "model": request["model"],
+                                "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_RERANK_REPLY}, "finish_reason": "stop"}],
+                                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+                body = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def _sleep(self, latency):
+        median, sigma = latency
+        with self._lock:
+            seconds = self._random_generator.lognormal(np.log(median), sigma)
+        time.sleep(seconds)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    corpus_index = CEMADCorpusIndex(os.getenv("DECRYPTION_KEY_CEMAD"))
+    stub = StubOpenAI()
+    openai_client = CachedEmbeddingsClient(OpenAI(api_key = "stub", base_url = stub.base_url, http_client = DefaultHttpxClient(), max_retries = 0), EmbeddingCache())
+    pipeline_config = PipelineConfig(openai_client = openai_client,
+                                     chat_model = "gpt-4o",
+                                     user_type = corpus_index.user_type,
+                                     corpus_description = corpus_index.corpus_description)
+    embedding_parameters = EmbeddingParameters("text-embedding-3-large", 1024)
+    index_embeddings = corpus_index.embedding_matrices["index"].exact_matrix
+    workflow_embeddings = corpus_index.embedding_matrices["workflow"].exact_matrix
+    no_workflow = corpus_index.get_no_workflow()
+    # (kind, embedding the stub answers with)
+    random_generator = np.random.default_rng(1)
+    turns = []
+    for _ in range(NUMBER_OF_TURNS):
+        kind = "workflow" if random_generator.random() < WORKFLOW_SHARE else "section"
+        embedding = index_embeddings[random_generator.integers(len(index_embeddings))]
+        if kind == "workflow":
+            # a documentation question about a topic the sections cover is close to both
+            embedding = workflow_embeddings[random_generator.integers(len(workflow_embeddings))] + embedding
+        turns.append((kind, (embedding / np.linalg.norm(embedding)).astype(float).tolist()))
+
+    chat = CorpusChatCEMAD(embedding_parameters = embedding_parameters,
+                           chat_parameters = ChatParameters(chat_model = "gpt-4o", api_key = "stub", temperature = 0, max_tokens = 500, token_limit_when_truncating_message_queue = 3500),
+                           corpus_index = corpus_index,
+                           rerank_algo = RerankAlgos.LLM,
+                           pipeline_config = pipeline_config)
+    latencies = {"section": [], "workflow": []}
+    for turn, (kind, embedding) in enumerate(turns):
+        question = f"{kind} question {turn}"
+        stub.embeddings[question] = embedding
+
+        start = time.perf_counter()
+        with use_pipeline_config(pipeline_config):
+            workflow_triggered, _, _ = chat.path_search.similarity_search(question)
+        latency = time.perf_counter() - start
+        latencies["section" if workflow_triggered == no_workflow else "workflow"].append(latency)
+
+    all_latencies = latencies["section"] + latencies["workflow"]
+    print(f"p50 {np.percentile(all_latencies, 50) * 1e3:.0f}ms, p95 {np.percentile(all_latencies, 95) * 1e3:.0f}ms over {len(all_latencies)} turns. "
+          f"{stub.chat_calls} rerank calls")
+    for kind in ["section", "workflow"]:
+        if latencies[kind]:
+            print(f"    {kind} turns: {len(latencies[kind])}, p50 {np.percentile(latencies[kind], 50) * 1e3:.0f}ms, p95 {np.percentile(latencies[kind], 95) * 1e3:.0f}ms")
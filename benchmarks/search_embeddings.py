@@ -0,0 +1,52 @@
+'''
+Compares EmbeddingMatrix.get_closest_nodes with regulations_rag.embeddings.get_closest_nodes (one scipy cosine per
+row) on the unencrypted embedding tables. Checks that both return the same rows and distances and prints the time
+per query.
+
+Run from the root of the repository: python benchmarks/search_embeddings.py
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from regulations_rag.embeddings import get_closest_nodes
+from cemad_rag.embedding_matrix import EmbeddingMatrix
+
+NUMBER_OF_QUERIES = 50
+THRESHOLD = 0.6
+
+
+def get_queries(df, number_of_queries, seed = 0):
+    ''' Rows of the table with a little noise added so each query has a close match and a spread of other distances '''
+    rng = np.random.default_rng(seed)
+    dimensions = len(df["embedding"].iloc[0])
+    return [np.asarray(df["embedding"].iloc[row]) + rng.normal(0, 0.02, dimensions) for row in rng.integers(0, len(df), number_of_queries)]
+
+
+if __name__ == "__main__":
+    for table_name in ["ad_definitions", "bopcodes"]:
+        df = pd.read_parquet(f"./inputs/index/{table_name}.parquet", engine = "pyarrow")
+        queries = get_queries(df, NUMBER_OF_QUERIES)
+
+        start = time.perf_counter()
+        embedding_matrix = EmbeddingMatrix(df)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        original = [get_closest_nodes(df, "embedding", query, threshold = THRESHOLD) for query in queries]
+        original_time = (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        matrix = [embedding_matrix.get_closest_nodes(query, THRESHOLD) for query in queries]
+        matrix_time = (time.perf_counter() - start) / len(queries)
+
+        same = all(sorted(a.index) == sorted(b.index) and np.allclose(np.sort(a["cosine_distance"].to_numpy()), np.sort(b["cosine_distance"].to_numpy()), atol = 1e-5)
+                   for a, b in zip(original, matrix))
+        print(f"{table_name}: {len(df)} rows, matrix built in {build_time * 1e3:.1f}ms. Per query: "
+              f"get_closest_nodes {original_time * 1e3:.2f}ms, EmbeddingMatrix {matrix_time * 1e3:.3f}ms ({original_time / matrix_time:.0f}x). "
+              f"{'Same results' if same else 'DIFFERENT RESULTS'}")
@@ -0,0 +1,82 @@
+'''
+Compares capping the RAG sections of a turn by re-encoding their text with tiktoken (what was done for every turn
+before the token counts were precomputed) with the cumulative sum over the precomputed counts that
+CEMADCorpusIndex.cap_rag_section_token_length uses, checks that both keep the same sections and prints the time
+taken by each per turn. Also prints the one-off cost of counting every section, which is paid when the index is
+built (and not at all when it is loaded from a snapshot).
+
+Each turn is NUMBER_OF_SECTIONS random sections of the CEMAD documents, as plain text, capped at CAP tokens. This
+needs the tiktoken encoding for the model but not the index or its key.
+
+Run from the root of the repository: python benchmarks/token_capping.py
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cemad_rag.cemad_corpus import CEMADCorpus
+from cemad_rag.token_counter import TokenCounter
+
+MODEL = "gpt-4o"
+NUMBER_OF_TURNS = 200
+NUMBER_OF_SECTIONS = 17
+CAP = 5000
+
+
+def re_encoding_cap(relevant_sections, capped_number_of_tokens, encoding):
+    ''' Encodes the text of each section, in order, and keeps the sections while the running total is within the cap '''
+    token_count = 0
+    kept = []
+    for text in relevant_sections["text"]:
+        token_count += len(encoding.encode(text))
+        kept.append(token_count <= capped_number_of_tokens)
+    return relevant_sections[np.array(kept, dtype = bool)]
+
+
+def cumulative_sum_cap(relevant_sections, capped_number_of_tokens):
+    ''' What CEMADCorpusIndex.cap_rag_section_token_length does with the precomputed counts '''
+    return relevant_sections[np.cumsum(relevant_sections["token_count"].to_numpy()) <= capped_number_of_tokens]
+
+
+if __name__ == "__main__":
+    corpus = CEMADCorpus("./cemad_rag/documents/")
+    sections = [(document_key, section_reference) for document_key in corpus.document_keys
+                for section_reference in corpus.get_document(document_key).section_store.sorted_references]
+    texts = [corpus.get_text(document_key, section_reference, add_markdown_decorators = False) for document_key, section_reference in sections]
+
+    token_counter = TokenCounter(MODEL)
+    token_counter.count("")  # load the encoding outside the timing
+    start = time.perf_counter()
+    token_counts = token_counter.count_all(texts)
+    build_time = time.perf_counter() - start
+    all_sections = pd.DataFrame({"document": [document_key for document_key, _ in sections],
+                                 "section_reference": [section_reference for _, section_reference in sections],
+                                 "text": texts,
+                                 "token_count": token_counts})
+    print(f"Counted the tokens of {len(all_sections)} sections ({token_counts.sum()} tokens) in {build_time * 1e3:.0f}ms, once when the index is built")
+
+    encoding = tiktoken.encoding_for_model(MODEL)
+    random_generator = np.random.default_rng(0)
+    turns = [all_sections.iloc[random_generator.choice(len(all_sections), NUMBER_OF_SECTIONS, replace = False)] for _ in range(NUMBER_OF_TURNS)]
+    timings = {"re-encoding": [], "cumulative sum": []}
+    differences = 0
+    for turn in turns:
+        start = time.perf_counter()
+        re_encoded = re_encoding_cap(turn, CAP, encoding)
+        timings["re-encoding"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        summed = cumulative_sum_cap(turn, CAP)
+        timings["cumulative sum"].append(time.perf_counter() - start)
+        differences += not re_encoded.index.equals(summed.index)
+
+    average_characters = np.mean([turn["text"].str.len().sum() for turn in turns])
+    print(f"{NUMBER_OF_TURNS} turns of {NUMBER_OF_SECTIONS} sections (about {average_characters:.0f} characters) capped at {CAP} tokens with the {encoding.name} encoding. "
+          f"{'Identical' if differences == 0 else f'{differences} turns differ'}")
+    for name, times in timings.items():
+        print(f"    {name:<15} p50 {np.percentile(times, 50) * 1e3:.3f}ms, p95 {np.percentile(times, 95) * 1e3:.3f}ms per turn")
@@ -0,0 +1,275 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+logger = logging.getLogger(__name__)
+
+
+class BlobLogShipper:
+    """
+    Appends log lines to Azure append blobs from a background thread so the request thread never waits for Azure.
+
+    write() puts the line on an in-process queue and returns. The worker waits up to batch_interval seconds after
+    the first line for more lines, then joins the lines for each blob into as few append_block calls as possible
+    (at most max_block_bytes each). A failed append is retried max_retries times with exponential backoff starting
+    at retry_delay seconds, after which the batch is dropped and a warning is logged.
+
+    The queue holds at most max_buffered_lines lines. If Azure is down for long enough to fill it, new lines are
+    dropped (and counted) rather than using more memory. close() is registered with atexit so whatever is queued is
+    shipped when the process shuts down.
+
+    submit() runs a function on the worker thread (e.g. GlobalLogUploader's upload), after the lines queued before
+    it have been shipped.
+
+    blob_client can be anything with an append_block(data) method, e.g. a local stand in for testing.
+    """
+    # Azure rejects an append_block larger than 4 MiB
+    MAXIMUM_BLOCK_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, batch_interval = 2.0, max_buffered_lines = 10000, max_block_bytes = MAXIMUM_BLOCK_BYTES, max_retries = 4, retry_delay = 0.5):
+        self.batch_interval = batch_interval
+        self.max_block_bytes = max_block_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.dropped_lines = 0
+        self.failed_blocks = 0
+        self._queue = queue.Queue(maxsize = max_buffered_lines)
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target = self._run, name = "blob-log-shipper", daemon = True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, blob_client, text):
+        ''' Queues text (str or bytes) to be appended to the blob. Never blocks '''
+        try:
+            self._queue.put_nowait((blob_client, text))
+        except queue.Full:
+            with self._lock:
+                self.dropped_lines += 1
+                dropped_lines = self.dropped_lines
+            if dropped_lines == 1 or dropped_lines % 1000 == 0:
+                logger.warning(f"The blob log queue is full. {dropped_lines} lines have been dropped")
+
+    def submit(self, function):
+        ''' Queues function to be run on the worker thread. Never blocks. Returns False if the queue is full '''
+        try:
+            self._queue.put_nowait((None, function))
+            return True
+        except queue.Full:
+            return False
+
+    def flush(self, timeout = None):
+        ''' Waits until everything queued so far has been shipped (or dropped after its retries). Returns False on timeout '''
+        done = threading.Event()
+        try:
+            self._queue.put((None, done.set), timeout = timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout = 10.0):
+        ''' Ships whatever is queued and stops the worker '''
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                first_item = self._queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            items = [first_item]
+            # wait for more lines unless a function is waiting to run or the process is shutting down
+            deadline = time.monotonic() + self.batch_interval
+            while items[-1][0] is not None and not self._stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout = remaining))
+                except queue.Empty:
+                    break
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._ship(items)
+
+    def _ship(self, items):
+        # the lines for each blob, in the order they were written
+        batches = {}
+        functions = []
+        for blob_client, text in items:
+            if blob_client is None:
+                functions.append(text)
+            else:
+                batches.setdefault(id(blob_client), (blob_client, []))[1].append(text)
+
+        for blob_client, texts in batches.values():
+            self.append_blocks(blob_client, texts)
+        if batches:
+            logger.log(DEV_LEVEL, f"Shipped {len(items) - len(functions)} log lines to {len(batches)} blobs")
+        for function in functions:
+            try:
+                function()
+            except Exception as e:
+                logger.warning(f"A function submitted to the blob log shipper failed: {e}")
+
+    def append_blocks(self, blob_client, texts):
+        ''' Appends texts to the blob now, in as few blocks as possible. Only call this on the worker thread (i.e. from a submitted function) '''
+        for block in self._get_blocks(texts):
+            self._append_with_retries(blob_client, block)
+
+    def _get_blocks(self, texts):
+        ''' Joins the texts into blocks of at most max_block_bytes (a single longer text is split) '''
+        block = b""
+        for text in texts:
+            data = text if isinstance(text, bytes) else text.encode("utf-8")
+            if block and len(block) + len(data) > self.max_block_bytes:
+                yield block
+                block = b""
+            block += data
+            while len(block) > self.max_block_bytes:
+                yield block[:self.max_block_bytes]
+                block = block[self.max_block_bytes:]
+        if block:
+            yield block
+
+    def _append_with_retries(self, blob_client, block):
+        for attempt in range(self.max_retries + 1):
+            try:
+                blob_client.append_block(block)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    with self._lock:
+                        self.failed_blocks += 1
+                    logger.warning(f"Dropped {len(block)} bytes of log data after {attempt + 1} failed appends: {e}")
+                    return
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+
+class RotatingAppendBlob:
+    """
+    An append blob that is continued in a new blob before it reaches Azure's limit of MAXIMUM_BLOCKS blocks.
+
+    The blobs are blob_name, then <name>.1<extension>, <name>.2<extension>, ... open_blob(blob_name) returns
+    (blob_client, number of blocks already in the blob), creating the blob if it does not exist, or None if the blob
+    cannot be appended to (e.g. it is a block blob from an older version of the app), in which case the next name is
+    tried. A blob that already has max_blocks blocks is skipped in the same way.
+
+    append_block counts the blocks and moves on to the next blob when the current one is full. Another instance of
+    the app may be appending to the same blob, so after a failed append the blob is opened again (which reads its
+    block count again) on the next attempt, e.g. BlobLogShipper's retry.
+
+    Only call append_block from one thread (the shipper's worker).
+    """
+    # Azure rejects an append_block to an append blob that has this many blocks
+    MAXIMUM_BLOCKS = 50000
+
+    def __init__(self, open_blob, blob_name, max_blocks = MAXIMUM_BLOCKS):
+        self.open_blob = open_blob
+        self.blob_name = blob_name
+        self.max_blocks = max_blocks
+        self._name, self._extension = os.path.splitext(blob_name)
+        self._sequence = 0
+        self._blob_client = None
+        self._block_count = 0
+        self._open()
+
+    @property
+    def current_blob_name(self):
+        if self._sequence == 0:
+            return self.blob_name
+        return f"{self._name}.{self._sequence}{self._extension}"
+
+    def append_block(self, data):
+        if self._blob_client is None:
+            self._open()
+        if self._block_count >= self.max_blocks:
+            self._sequence += 1
+            self._open()
+        try:
+            self._blob_client.append_block(data)
+        except Exception:
+            self._blob_client = None
+            raise
+        self._block_count += 1
+
+    def _open(self):
+        ''' Opens the current blob, or the first one after it that can be appended to '''
+        while True:
+            opened = self.open_blob(self.current_blob_name)
+            if opened is not None and opened[1] < self.max_blocks:
+                break
+            self._sequence += 1
+        self._blob_client, self._block_count = opened
+        if self._sequence > 0:
+            logger.info(f"Appending to {self.current_blob_name}, which has {self._block_count} blocks")
+
+
+class GlobalLogUploader:
+    """
+    Appends the new part of the local (rotating) log file to an append blob, instead of uploading the whole file.
+
+    The position of the last uploaded byte and the inode of the file are remembered. RotatingFileHandler renames the
+    file to <file>.1 when it is full and starts a new one, so if the inode has changed the rest of the old file is
+    read from <file>.1 before the new file is read from the start. Only the first backup is checked so the log file
+    should not rotate more than once between uploads.
+
+    upload() submits the work to the BlobLogShipper so it runs on the shipper's thread, never the request thread.
+    The last upload is submitted when the process shuts down.
+    """
+    def __init__(self, log_file_name, blob_client, blob_log_shipper):
+        self.log_file_name = log_file_name
+        self.blob_client = blob_client
+        self.blob_log_shipper = blob_log_shipper
+        self._inode = None
+        self._offset = 0
+        # registered after the shipper so it runs before the shipper is closed
+        atexit.register(self.upload)
+
+    def upload(self):
+        ''' Queues an upload of everything added to the log file since the last one '''
+        if not self.blob_log_shipper.submit(self._upload_new_data):
+            logger.warning("The blob log queue is full. The global log will be uploaded next time")
+
+    def _upload_new_data(self):
+        try:
+            status = os.stat(self.log_file_name)
+        except FileNotFoundError:
+            return
+        if self._inode is not None and status.st_ino != self._inode:
+            backup_file_name = self.log_file_name + ".1"
+            if os.path.exists(backup_file_name) and os.stat(backup_file_name).st_ino == self._inode:
+                self._upload_from(backup_file_name, self._offset)
+            else:
+                logger.warning(f"{self.log_file_name} was rotated more than once since the last upload. Some of the log was not uploaded")
+            self._offset = 0
+        elif status.st_size < self._offset:
+            # truncated (e.g. by setup_logging)
+            self._offset = 0
+        self._inode = status.st_ino
+        self._offset = self._upload_from(self.log_file_name, self._offset)
+
+    def _upload_from(self, file_name, offset):
+        ''' Appends the content of the file from offset and returns the offset of the end of what was uploaded '''
+        with open(file_name, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+        if data:
+            self.blob_log_shipper.append_blocks(self.blob_client, [data])
+            logger.log(DEV_LEVEL, f"Uploaded {len(data)} bytes of {file_name}")
+        return offset + len(data)
@@ -0,0 +1,132 @@
+import copy
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from cemad_rag.embedding_matrix import EmbeddingMatrix
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class AnswerCache:
+    """
+    A cache of the answers to stand alone (strict RAG) questions keyed by the question embedding and the corpus
+    version. A question hits the cache if an earlier question for the same corpus version is within
+    maximum_distance (cosine distance) of it, so near identical FAQ questions ("how much can I take offshore in a
+    year?") share an answer. maximum_distance should be small: only rephrasings of the same question should match.
+
+    The entries are the messages the chat added for the answer (see CorpusChatCEMAD.user_provides_input). There are
+    at most max_size entries, the least recently used are dropped first, and entries expire time_to_live seconds
+    after they were added (an expired entry is removed when it matches a question, and the next closest match is
+    used instead, or on the next put). One cache
+    is shared by every session in the process so it is locked, and every get returns a copy. The optional
+    database_path is a SQLite file so the answers survive restarts.
+
+    NOTE: The database contains pickled answers so it must be as private as the index snapshot.
+    """
+    def __init__(self, max_size = 1024, time_to_live = 24 * 3600, maximum_distance = 0.02, database_path = None):
+        self.max_size = max_size
+        self.time_to_live = time_to_live
+        self.maximum_distance = maximum_distance
+        self.hits = 0
+        self.misses = 0
+        # id -> (corpus_version, unit length embedding, messages, created)
+        self._entries = OrderedDict()
+        self._next_id = 0
+        # one matrix per corpus version with the embeddings of its entries, rebuilt after any change
+        self._matrices = None
+        self._lock = threading.Lock()
+
+        self._database = None
+        if database_path is not None:
+            self._database = sqlite3.connect(database_path, check_same_thread = False)
+            self._database.execute("PRAGMA journal_mode=WAL")
+            self._database.execute("CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY, corpus_version TEXT, embedding BLOB, messages BLOB, created REAL)")
+            self._database.execute("DELETE FROM answers WHERE created < ?", (time.time() - time_to_live,))
+            self._database.commit()
+            rows = self._database.execute("SELECT id, corpus_version, embedding, messages, created FROM answers ORDER BY id DESC LIMIT ?", (max_size,)).fetchall()
+            for entry_id, corpus_version, embedding, messages, created in reversed(rows):
+                self._entries[entry_id] = (corpus_version, np.frombuffer(embedding, dtype = np.float32), pickle.loads(messages), created)
+            self._next_id = max([row[0] for row in rows], default = -1) + 1
+            logger.log(DEV_LEVEL, f"Loaded {len(self._entries)} answers from {database_path}")
+
+    def _remove(self, entry_ids):
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+        if self._database is not None and entry_ids:
+            self._database.executemany("DELETE FROM answers WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+            self._database.commit()
+        self._matrices = None
+
+    def _remove_expired(self):
+        expiry = time.time() - self.time_to_live
+        self._remove([entry_id for entry_id, (_, _, _, created) in self._entries.items() if created < expiry])
+
+    def _get_matrices(self):
+        if self._matrices is None:
+            entries = {}
+            for entry_id, (corpus_version, embedding, _, _) in self._entries.items():
+                entries.setdefault(corpus_version, ([], []))
+                entries[corpus_version][0].append(entry_id)
+                entries[corpus_version][1].append(embedding)
+            self._matrices = {corpus_version: (entry_ids, np.vstack(embeddings)) for corpus_version, (entry_ids, embeddings) in entries.items()}
+        return self._matrices
+
+    def get(self, corpus_version, question_embedding):
+        ''' A copy of the messages stored for the closest unexpired question within maximum_distance, or None '''
+        query = EmbeddingMatrix.normalise(question_embedding)[0]
+        with self._lock:
+            entry_ids, matrix = self._get_matrices().get(corpus_version, ([], None))
+            messages = None
+            expired = []
+            if matrix is not None:
+                distances = 1.0 - matrix @ query
+                matches = np.flatnonzero(distances <= self.maximum_distance)
+                expiry = time.time() - self.time_to_live
+                for match in matches[np.argsort(distances[matches], kind = "stable")]:
+                    entry_id = entry_ids[match]
+                    if self._entries[entry_id][3] < expiry:
+                        expired.append(entry_id)
+                        continue
+                    self._entries.move_to_end(entry_id)
+                    messages = copy.deepcopy(self._entries[entry_id][2])
+                    logger.log(DEV_LEVEL, f"Answer cache hit at a distance of {distances[match]:.4f}")
+                    break
+            self._remove(expired)
+            if messages is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return messages
+
+    def put(self, corpus_version, question_embedding, messages):
+        embedding = EmbeddingMatrix.normalise(question_embedding)[0]
+        messages = copy.deepcopy(messages)
+        created = time.time()
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (corpus_version, embedding, messages, created)
+            if self._database is not None:
+                self._database.execute("INSERT INTO answers VALUES (?, ?, ?, ?, ?)", (entry_id, corpus_version, embedding.tobytes(), pickle.dumps(messages), created))
+                self._database.commit()
+            self._remove_expired()
+            self._remove(list(self._entries)[:max(0, len(self._entries) - self.max_size)])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                    "size": len(self._entries),
+                    "max_size": self.max_size}
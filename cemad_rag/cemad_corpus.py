@@ -1,14 +1,71 @@
+import hashlib
+import logging
+import threading
+import pandas as pd
+
 from cemad_rag.documents.cemad import CEMAD
 from cemad_rag.documents.cemad_user_queries import CEMAD_User_Queries
+from cemad_rag.rendered_text_cache import rendered_text_cache
 
 
 from regulations_rag.corpus import Corpus , create_document_dictionary_from_folder
 
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
 
 class CEMADCorpus(Corpus):
-    def __init__(self, folder):
-        document_dictionary = create_document_dictionary_from_folder(folder, globals())
+    def __init__(self, folder, document_dataframes = None):
+        '''
+            document_dataframes: optional dictionary of document_key (the class name) -> already parsed document_as_df,
+                                 used to build the documents without loading their csv files again
+        '''
+        if document_dataframes is None:
+            document_dictionary = create_document_dictionary_from_folder(folder, globals())
+        else:
+            document_dictionary = {document_key: globals()[document_key](document_as_df = document_as_df) for document_key, document_as_df in document_dataframes.items()}
         super().__init__(document_dictionary)
+        self.document_keys = list(document_dictionary.keys())
+        self.version = self._get_version(document_dictionary)
+        self._toc_lock = threading.Lock()
+
+    def _get_version(self, document_dictionary):
+        ''' A hash of the content of all the documents. Used to invalidate cached text when the documents change '''
+        version = hashlib.sha256()
+        for document_key in sorted(document_dictionary.keys()):
+            version.update(document_key.encode("utf-8"))
+            version.update(pd.util.hash_pandas_object(document_dictionary[document_key].document_as_df, index = True).values.tobytes())
+        return version.hexdigest()
 
     def get_primary_document(self):
         return "CEMAD"
+
+    def get_text(self, document_key, section_reference, add_markdown_decorators = True, add_headings = True, section_only = False):
+        def render():
+            return super(CEMADCorpus, self).get_text(document_key, section_reference, add_markdown_decorators = add_markdown_decorators, add_headings = add_headings, section_only = section_only)
+
+        key = (self.version, document_key, section_reference, add_markdown_decorators, add_headings, section_only)
+        return rendered_text_cache.get_or_render(key, render)
+
+    def warm_text_cache(self):
+        """ Renders every section of every document, with and without markdown decorators, into the shared text cache """
+        for document_key in self.document_keys:
+            for section_reference in self.get_document(document_key).section_store.sorted_references:
+                for add_markdown_decorators in [True, False]:
+                    self.get_text(document_key, section_reference, add_markdown_decorators = add_markdown_decorators)
+        logger.log(ANALYSIS_LEVEL, f"Text cache warmed: {rendered_text_cache.stats()}")
+
+    def get_toc(self, document_key):
+        """ The table of content of the document. It is built once, the first time it is asked for, and must not be changed """
+        with self._toc_lock:
+            return self.get_document(document_key).toc
+
+    def get_document_dataframes(self):
+        return {document_key: self.get_document(document_key).document_as_df for document_key in self.document_keys}
+
+    def get_headings(self, document_key, section_references, add_markdown_decorators = False):
+        """ The headings for a batch of section_references from the same document, in the same order """
+        return self.get_document(document_key).get_headings(section_references, add_markdown_decorators)
@@ -1,49 +1,402 @@
+import copy
 import logging
 import os
+import re
+import numpy as np
 import pandas as pd
 
 from regulations_rag.file_tools import load_parquet_data
 from regulations_rag.corpus_index import DataFrameCorpusIndex
+from regulations_rag.rerank import RerankAlgos
 from cemad_rag.cemad_corpus import CEMADCorpus
+from cemad_rag.embedding_matrix import EmbeddingMatrix
+from cemad_rag.ivf_index import IVFIndex
+from cemad_rag.lexical_index import BM25Index, reciprocal_rank_fusion
+from cemad_rag.cross_reference_graph import CrossReferenceGraph
+from cemad_rag.token_counter import TokenCounter
+from cemad_rag.corpus_index_snapshot import get_snapshot_key, load_snapshot, save_snapshot
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
 DEV_LEVEL = 15
-logging.addLevelName(DEV_LEVEL, 'DEV')       
+logging.addLevelName(DEV_LEVEL, 'DEV')
 
 class CEMADCorpusIndex(DataFrameCorpusIndex):
-    def __init__(self, key):
-        corpus = CEMADCorpus("./cemad_rag/documents/")
+    """
+    One instance is shared, read only, by every session in the process (see load_cemad_corpus_index) and may be
+    used by many threads at once:
+    - the DataFrames and embedding matrices are never changed after __init__. Searches run on shallow copies
+      (_restricted_to_candidates) so the shared tables are not touched;
+    - the rendered text cache is locked and the SectionStore memos are bounded functools.lru_caches.
+    Anything that needs to change per session belongs in the chat, not here.
+    """
+    # Added to the threshold when the float32 matrices select candidates so that DataFrameCorpusIndex, which
+    # scores the candidates again, makes the final decision for rows right on the threshold
+    CANDIDATE_THRESHOLD_MARGIN = 1e-4
+    # Cosine distances are at most 2 so DataFrameCorpusIndex keeps every candidate when it is given this threshold
+    ACCEPT_ALL_THRESHOLD = 2.1
+    # Number of rows taken from the lexical ranking, and the maximum number of fused candidates, in hybrid search
+    LEXICAL_CANDIDATES = 20
+    MAXIMUM_HYBRID_CANDIDATES = 25
+    # BM25 score a row needs to count as a lexical match. A single match on a term that is in most rows scores less
+    MINIMUM_LEXICAL_SCORE = 2.0
+    # Number of rows returned by the lexical only searches
+    LEXICAL_ONLY_RESULTS = {"definitions": 3, "index": 10}
+    # Sections referenced directly in a question are only used if their text is shorter than this (i.e. not a whole chapter)
+    MAXIMUM_DIRECT_REFERENCE_CHARACTERS = 20000
+    # The integer column, in the index, definitions and workflow, with the number of tokens in the text each row adds to the RAG data
+    TOKEN_COUNT_COLUMN = "token_count"
+
+    def __init__(self, key, snapshot_folder = None, embedding_precision = "float32", ann_number_of_probes = None, lexical_search = False, hybrid_search = False, token_count_model = "gpt-4o"):
+        '''
+            snapshot_folder: optional local folder for a snapshot of the assembled index, definitions, workflow and
+                             parsed documents. If a snapshot for the current input files exists it is loaded
+                             instead of rebuilding everything, otherwise one is written after the rebuild.
+            embedding_precision: "float32", "float16" or "int8". See EmbeddingMatrix. With the quantized options the
+                                 embedding columns are removed from the index, definitions and workflow DataFrames.
+            ann_number_of_probes: if not None, use the approximate (IVF) indexes saved by build_ann_indexes() for the
+                                  tables that have one, probing this many lists per query. Higher is slower with
+                                  better recall. Small tables are always searched exactly.
+            lexical_search: build in-memory BM25 indexes over the definitions and the index (the index text plus the
+                            text of the section it points to) for get_lexical_definitions and get_lexical_sections,
+                            which need no embedding.
+            hybrid_search: also use the BM25 index in get_relevant_sections. The dense matches (within the threshold)
+                           and lexical matches (scoring above MINIMUM_LEXICAL_SCORE) are combined with reciprocal rank
+                           fusion, only the best MAXIMUM_HYBRID_CANDIDATES rows are passed on to be reranked and the
+                           sections are returned in the fused order. Implies lexical_search.
+            token_count_model: the chat model whose encoding is used for the token counts. The counts are computed
+                               once, when the index is built, and kept in the snapshot.
+        '''
+        document_folder = "./cemad_rag/documents/"
         index_folder = "./inputs/index/"
-        index_df = pd.DataFrame()
+        self.index_folder = index_folder
+        self.token_counter = TokenCounter(token_count_model)
         list_of_index_files = ["ad_index.parquet", "ad_index_plus.parquet"]
-        # for filename in os.listdir(index_folder):
-        for filename in list_of_index_files:
-            if filename.endswith(".parquet"):  
-                filepath = os.path.join(index_folder, filename)
-                df = load_parquet_data(filepath, key)
-                index_df = pd.concat([index_df, df], ignore_index = True)
-
-        df_index_df = pd.DataFrame()
         list_of_definitions_index_files = ["ad_definitions.parquet"]
-        for filename in list_of_definitions_index_files:
-            if filename.endswith(".parquet"):  
-                filepath = os.path.join(index_folder, filename)
-                df = pd.read_parquet(filepath, engine="pyarrow") # not encrypted
-                df_index_df = pd.concat([df_index_df, df], ignore_index = True)
+        workflow_file = "workflow.parquet"
+
+        input_files = [os.path.join(index_folder, filename) for filename in list_of_index_files + list_of_definitions_index_files + [workflow_file]]
+        csv_folder = "./inputs/documents/"
+        input_files += [os.path.join(csv_folder, filename) for filename in sorted(os.listdir(csv_folder))]
+        # Also identifies the index for anything cached from it, e.g. the answers in an AnswerCache
+        self.snapshot_key = get_snapshot_key(input_files, key, settings = token_count_model)
+
+        snapshot = None
+        if snapshot_folder is not None:
+            snapshot = load_snapshot(snapshot_folder, self.snapshot_key)
+
+        if snapshot is not None:
+            document_dataframes = {name[len("document_"):]: df for name, df in snapshot.items() if name.startswith("document_")}
+            corpus = CEMADCorpus(document_folder, document_dataframes = document_dataframes)
+            index = snapshot["index"]
+            definitions = snapshot["definitions"]
+            workflow = snapshot["workflow"]
+        else:
+            corpus = CEMADCorpus(document_folder)
+            index_dfs = []
+            # for filename in os.listdir(index_folder):
+            for filename in list_of_index_files:
+                if filename.endswith(".parquet"):
+                    filepath = os.path.join(index_folder, filename)
+                    index_dfs.append(load_parquet_data(filepath, key))
+            index = pd.concat(index_dfs, ignore_index = True)
+
+            definitions_dfs = []
+            for filename in list_of_definitions_index_files:
+                if filename.endswith(".parquet"):
+                    filepath = os.path.join(index_folder, filename)
+                    definitions_dfs.append(pd.read_parquet(filepath, engine="pyarrow")) # not encrypted
+            definitions = pd.concat(definitions_dfs, ignore_index = True)
+            definitions["text"] = definitions["definition"]
 
-        user_type = "an Authorised Dealer (AD)" 
+            workflow = pd.read_parquet(os.path.join(index_folder, workflow_file), engine="pyarrow")
+            self._add_token_counts(corpus, index, definitions, workflow)
+
+            if snapshot_folder is not None:
+                frames = {"index": index, "definitions": definitions, "workflow": workflow}
+                for document_key, document_as_df in corpus.get_document_dataframes().items():
+                    frames["document_" + document_key] = document_as_df
+                save_snapshot(snapshot_folder, self.snapshot_key, frames)
+
+        user_type = "an Authorised Dealer (AD)"
         corpus_description = "South African \'Currency and Exchange Manual for Authorised Dealers\' (CEMAD)"
 
-        definitions = df_index_df
-        definitions["text"] = definitions["definition"]
-        index = index_df
-        workflow = pd.read_parquet(os.path.join(index_folder, "workflow.parquet"), engine="pyarrow")
+        self.embedding_matrices = {"index": EmbeddingMatrix(index, precision = embedding_precision),
+                                   "definitions": EmbeddingMatrix(definitions, precision = embedding_precision),
+                                   "workflow": EmbeddingMatrix(workflow, precision = embedding_precision)}
+        # with quantized precisions the matrices keep the DataFrames without their embedding column
+        index = self.embedding_matrices["index"].df
+        definitions = self.embedding_matrices["definitions"].df
+        workflow = self.embedding_matrices["workflow"].df
 
         super().__init__(user_type, corpus_description, corpus, definitions, index, workflow)
+        self.section_token_counts = dict(zip(zip(index["document"], index["section_reference"]), index[self.TOKEN_COUNT_COLUMN].to_list()))
+
+        self.hybrid_search = hybrid_search
+        self.lexical_indexes = self._build_lexical_indexes() if lexical_search or hybrid_search else None
+        self._no_workflow = None
+
+        # built offline by build_cross_reference_graph()
+        self.cross_reference_graph = None
+        if os.path.exists(self._get_cross_reference_graph_filepath()):
+            self.cross_reference_graph = CrossReferenceGraph.load(self._get_cross_reference_graph_filepath(), self.corpus)
+
+        if ann_number_of_probes is not None:
+            for table_name, embedding_matrix in self.embedding_matrices.items():
+                filepath = self._get_ann_index_filepath(table_name)
+                if os.path.exists(filepath):
+                    if not embedding_matrix.set_ann_index(IVFIndex.load(filepath), ann_number_of_probes):
+                        logger.warning(f"{filepath} was not built from the current {table_name} table. Using exact search. Run build_ann_indexes() to rebuild it")
+
+    def _add_token_counts(self, corpus, index, definitions, workflow):
+        '''
+            Adds TOKEN_COUNT_COLUMN to the tables. For the index it is the count for the plain text (no markdown
+            decorators) of the section the row points to, which is what is sent to the model
+        '''
+        sections = list(dict.fromkeys(zip(index["document"], index["section_reference"])))
+        section_texts = [corpus.get_text(document_key, section_reference, add_markdown_decorators = False) for document_key, section_reference in sections]
+        section_token_counts = dict(zip(sections, self.token_counter.count_all(section_texts)))
+        index[self.TOKEN_COUNT_COLUMN] = np.array([section_token_counts[section] for section in zip(index["document"], index["section_reference"])], dtype = np.int32)
+        definitions[self.TOKEN_COUNT_COLUMN] = self.token_counter.count_all(definitions["text"])
+        workflow[self.TOKEN_COUNT_COLUMN] = self.token_counter.count_all(workflow["text"])
+        logger.log(DEV_LEVEL, f"Counted the tokens in {len(sections)} sections, {len(definitions)} definitions and {len(workflow)} workflows")
+
+    def get_token_counts(self, relevant_data):
+        '''
+            The token count of each row of relevant_data (sections or definitions found by a search). Uses
+            TOKEN_COUNT_COLUMN where it is set. Rows without it (e.g. sections added by reference) use the count of
+            their section in the index, or are counted now
+        '''
+        if self.TOKEN_COUNT_COLUMN in relevant_data.columns:
+            token_counts = relevant_data[self.TOKEN_COUNT_COLUMN].to_numpy(dtype = np.float64, na_value = np.nan)
+        else:
+            token_counts = np.full(len(relevant_data), np.nan)
+        for position in np.flatnonzero(np.isnan(token_counts)):
+            row = relevant_data.iloc[position]
+            token_count = self.section_token_counts.get((row.get("document"), row.get("section_reference")))
+            token_counts[position] = token_count if token_count is not None else self.token_counter.count(row["text"])
+        return token_counts.astype(np.int64)
+
+    def cap_rag_section_token_length(self, relevant_sections, capped_number_of_tokens):
+        '''
+            The leading rows of relevant_sections whose cumulative token count is at most capped_number_of_tokens.
+            The counts come from get_token_counts so no text is encoded
+        '''
+        return relevant_sections[np.cumsum(self.get_token_counts(relevant_sections)) <= capped_number_of_tokens]
+
+    def _get_ann_index_filepath(self, table_name):
+        return os.path.join(self.index_folder, f"{table_name}_ivf.npz")
+
+    def build_ann_indexes(self, number_of_lists = None, minimum_number_of_rows = EmbeddingMatrix.EXACT_SEARCH_BELOW):
+        """
+        Builds and saves an IVF index, next to the parquet files, for each table with at least minimum_number_of_rows
+        rows. This is meant to be run offline, whenever the index files change.
+        """
+        for table_name, embedding_matrix in self.embedding_matrices.items():
+            if len(embedding_matrix.df) >= minimum_number_of_rows:
+                IVFIndex.build(embedding_matrix, number_of_lists = number_of_lists).save(self._get_ann_index_filepath(table_name))
+
+    def _get_cross_reference_graph_filepath(self):
+        return os.path.join(self.index_folder, "cross_references.parquet")
+
+    def build_cross_reference_graph(self):
+        """
+        Scans every row of the documents for references to other sections and saves the graph, with the token count
+        of each referenced section, next to the parquet files. This is meant to be run offline, whenever the documents
+        change (or run python -m cemad_rag.cross_reference_graph, which does not need the index). See
+        expand_with_cross_references.
+        """
+        self.cross_reference_graph = CrossReferenceGraph.build(self.corpus, self.token_counter)
+        self.cross_reference_graph.save(self._get_cross_reference_graph_filepath())
+
+    def _build_lexical_indexes(self):
+        section_texts = {}
+        index_texts = []
+        for document_key, section_reference, text in zip(self.index["document"], self.index["section_reference"], self.index["text"]):
+            if (document_key, section_reference) not in section_texts:
+                section_text = None
+                if document_key in self.corpus.document_keys:
+                    section_text = self.corpus.get_document(document_key).section_renderer.render(section_reference, add_markdown_decorators = False)
+                section_texts[(document_key, section_reference)] = section_text or ""
+            index_texts.append(str(text) + " " + section_texts[(document_key, section_reference)])
+        return {"index": BM25Index(index_texts), "definitions": BM25Index(self.definitions["text"].to_list())}
+
+    def _restricted_to_rows(self, table_name, rows):
+        """ Returns a shallow copy of this index where the table table_name only has the rows at the positions in rows """
+        restricted_index = copy.copy(self)
+        setattr(restricted_index, table_name, self.embedding_matrices[table_name].get_rows_frame(rows))
+        return restricted_index
+
+    def _restricted_to_candidates(self, table_name, user_content_embedding, threshold):
+        """
+        Returns a shallow copy of this index where the table table_name only has the rows within threshold of
+        user_content_embedding. The DataFrameCorpusIndex methods are run on the copy so they only score the
+        candidates but still return exactly what they would have returned using the full table.
+        """
+        rows, _ = self.embedding_matrices[table_name].get_closest_rows(user_content_embedding, threshold + self.CANDIDATE_THRESHOLD_MARGIN)
+        return self._restricted_to_rows(table_name, rows)
+
+    def _get_hybrid_candidate_rows(self, user_content, user_content_embedding, threshold):
+        '''
+            The dense matches and the best lexical matches for the index, fused and capped at MAXIMUM_HYBRID_CANDIDATES,
+            best first. The dense matches are the rows within threshold (the exact float32 distance, as there is no
+            rescoring margin for them downstream) so only lexical matches can be further away
+        '''
+        dense_rows, dense_distances = self.embedding_matrices["index"].get_closest_rows(user_content_embedding, threshold)
+        dense_rows = dense_rows[dense_distances < threshold]
+        lexical_rows, _ = self.lexical_indexes["index"].get_top_rows(user_content, self.LEXICAL_CANDIDATES, self.MINIMUM_LEXICAL_SCORE)
+        rows = reciprocal_rank_fusion([dense_rows, lexical_rows])[:self.MAXIMUM_HYBRID_CANDIDATES]
+        logger.log(DEV_LEVEL, f"Hybrid search: {len(dense_rows)} dense and {len(lexical_rows)} lexical matches fused into {len(rows)} candidates")
+        return rows
+
+    def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
+        restricted_index = self._restricted_to_candidates("definitions", user_content_embedding, threshold)
+        return super(CEMADCorpusIndex, restricted_index).get_relevant_definitions(user_content, user_content_embedding, threshold)
+
+    def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = RerankAlgos.NONE):
+        rows, candidate_threshold = self._get_section_candidates(user_content, user_content_embedding, threshold)
+        return self.rerank_sections(user_content, user_content_embedding, rows, candidate_threshold, rerank_algo, ranked = self.hybrid_search)
+
+    def rerank_sections(self, user_content, user_content_embedding, rows, threshold, rerank_algo = RerankAlgos.NONE, ranked = False):
+        '''
+            The index rows at the positions in rows that are within threshold, reranked for
+            user_content. DataFrameCorpusIndex orders the sections by cosine distance. If ranked, rows are best first
+            (e.g. the hybrid fused ranking) and the sections are returned in that order instead
+        '''
+        section_ranks = None
+        if ranked:
+            sections = zip(self.index["document"].to_numpy()[rows], self.index["section_reference"].to_numpy()[rows])
+            section_ranks = {}
+            for rank, section in enumerate(sections):
+                section_ranks.setdefault(section, rank)
+        restricted_index = self._restricted_to_rows("index", rows)
+        relevant_sections = super(CEMADCorpusIndex, restricted_index).get_relevant_sections(user_content, user_content_embedding, threshold, rerank_algo)
+        if section_ranks is None or len(relevant_sections) == 0:
+            return relevant_sections
+        ranks = [section_ranks.get(section, len(section_ranks)) for section in zip(relevant_sections["document"], relevant_sections["section_reference"])]
+        return relevant_sections.iloc[np.argsort(ranks, kind = "stable")]
+
+    def _get_section_candidates(self, user_content, user_content_embedding, threshold):
+        ''' The positions of the index rows to score and rerank, and the threshold DataFrameCorpusIndex should apply to them '''
+        if self.hybrid_search:
+            # The lexical matches can be further than threshold from the question so the candidates are chosen here
+            return self._get_hybrid_candidate_rows(user_content, user_content_embedding, threshold), self.ACCEPT_ALL_THRESHOLD
+        rows, _ = self.embedding_matrices["index"].get_closest_rows(user_content_embedding, threshold + self.CANDIDATE_THRESHOLD_MARGIN)
+        return rows, threshold
+
+    def get_relevant_workflow(self, user_content_embedding, threshold):
+        restricted_index = self._restricted_to_candidates("workflow", user_content_embedding, threshold)
+        return super(CEMADCorpusIndex, restricted_index).get_relevant_workflow(user_content_embedding, threshold)
+
+    def get_no_workflow(self):
+        ''' The value get_relevant_workflow returns when no workflow is triggered '''
+        if self._no_workflow is None:
+            dimensions = self.embedding_matrices["index"].exact_matrix.shape[1]
+            self._no_workflow = self.get_relevant_workflow(np.zeros(dimensions, dtype = np.float32), threshold = -1.0)
+        return self._no_workflow
+
+    def get_no_definitions(self):
+        ''' An empty DataFrame with the columns of the definitions found by a search '''
+        return self.embedding_matrices["definitions"].get_rows_frame(np.empty(0, dtype = np.intp)).assign(cosine_distance = np.nan)
+
+    def _get_section_rows(self, sections, cosine_distance):
+        """
+        sections: dicts with the section_reference, document, text and source of each section. Returns them as rows
+        with the columns of the index. They were not found by embedding so their embedding is a zero vector (of the
+        right length, which EmbeddingMatrix.normalise leaves as zero) rather than NaN
+        """
+        section_rows = pd.DataFrame(sections).reindex(columns = self.index.columns)
+        embedding_matrix = self.embedding_matrices["index"]
+        if embedding_matrix.embedding_column_name in section_rows.columns:
+            dimensions = embedding_matrix.exact_matrix.shape[1]
+            section_rows[embedding_matrix.embedding_column_name] = [np.zeros(dimensions) for _ in range(len(section_rows))]
+        section_rows["cosine_distance"] = cosine_distance
+        return section_rows
+
+    def get_direct_reference_sections(self, user_content):
+        """
+        (sections, too_long_references): the sections of the primary document referred to explicitly in user_content
+        (e.g. 'what does B.4(B)(ii) say') as rows with the columns of the index and a cosine_distance of 0, so they
+        can be used as the search results without an embedding, search or rerank, and the references that were left
+        out because their text is longer than MAXIMUM_DIRECT_REFERENCE_CHARACTERS. References to a whole chapter
+        (e.g. 'B.') or that are not in the document are ignored. The sections are not capped (see
+        cap_rag_section_token_length).
+        """
+        document_key = self.corpus.get_primary_document()
+        document = self.corpus.get_document(document_key)
+        sections = []
+        too_long_references = []
+        for section_reference in document.reference_checker.extract_valid_references(user_content):
+            if not re.search(r"[\d(]", section_reference):
+                continue
+            text = document.section_renderer.render(section_reference, add_markdown_decorators = False)
+            if text is None:
+                continue
+            if len(text) > self.MAXIMUM_DIRECT_REFERENCE_CHARACTERS:
+                too_long_references.append(section_reference)
+                continue
+            sections.append({"section_reference": section_reference, "document": document_key, "text": text, "source": "reference"})
+        if too_long_references:
+            logger.log(DEV_LEVEL, f"The sections {too_long_references} referred to directly are longer than {self.MAXIMUM_DIRECT_REFERENCE_CHARACTERS} characters")
+        return self._get_section_rows(sections, 0.0), too_long_references
+
+    def expand_with_cross_references(self, relevant_sections, token_budget):
+        """
+        Appends to relevant_sections the sections they refer to (one hop in the cross reference graph), most referred
+        to first, while the referenced sections fit in token_budget. Sections that are already included, on their own
+        or as part of a larger section, are skipped. The token counts were stored when the graph was built so there
+        are no embedding calls. The added rows have the source 'cross reference' and no cosine_distance.
+        Returns relevant_sections unchanged if there is no graph (see build_cross_reference_graph).
+        """
+        if self.cross_reference_graph is None or token_budget <= 0 or len(relevant_sections) == 0:
+            return relevant_sections
+        retrieved_sections = list(dict.fromkeys(zip(relevant_sections["document"], relevant_sections["section_reference"])))
+        sections = []
+        for document_key, section_reference in self.cross_reference_graph.get_one_hop_sections(retrieved_sections, token_budget):
+            text = self.corpus.get_document(document_key).section_renderer.render(section_reference, add_markdown_decorators = False)
+            sections.append({"section_reference": section_reference, "document": document_key, "text": text, "source": "cross reference"})
+        if not sections:
+            return relevant_sections
+        logger.log(DEV_LEVEL, f"Added the cross referenced sections {[section['section_reference'] for section in sections]}")
+        return pd.concat([relevant_sections, self._get_section_rows(sections, np.nan)], ignore_index = True)
+
+    def _get_lexical_matches(self, table_name, user_content):
+        rows, _ = self.lexical_indexes[table_name].get_top_rows(user_content, self.LEXICAL_CANDIDATES, self.MINIMUM_LEXICAL_SCORE)
+        matches = self.embedding_matrices[table_name].get_rows_frame(rows)
+        # there is no embedding for the question so there is no distance
+        matches["cosine_distance"] = np.nan
+        if table_name == "index":
+            matches = matches.drop_duplicates(subset = ["document", "section_reference"])
+        return matches.head(self.LEXICAL_ONLY_RESULTS[table_name])
+
+    def get_lexical_definitions(self, user_content):
+        ''' The definitions with the highest BM25 score for user_content. Needs lexical_search '''
+        return self._get_lexical_matches("definitions", user_content)
+
+    def get_lexical_sections(self, user_content):
+        ''' One row per section for the index rows with the highest BM25 score for user_content, best first. Needs lexical_search. Nothing is reranked '''
+        return self._get_lexical_matches("index", user_content)
+
+    def count_relevant_hits(self, user_content_embeddings, threshold_definitions, threshold):
+        """
+        Returns, for each embedding in user_content_embeddings, the number of definitions plus the number of distinct
+        sections within the thresholds. All the embeddings are scored together and nothing is reranked so this is
+        only meant to compare queries with each other (e.g. alternative questions), not to retrieve data.
+        """
+        definition_matches = self.embedding_matrices["definitions"].get_matches(user_content_embeddings, threshold_definitions)
+        section_matches = self.embedding_matrices["index"].get_matches(user_content_embeddings, threshold)
+        section_codes, _ = pd.factorize(pd.MultiIndex.from_frame(self.index[["document", "section_reference"]]))
+        number_of_sections = np.array([len(np.unique(section_codes[matches])) for matches in section_matches], dtype = int)
+        return definition_matches.sum(axis = 1) + number_of_sections
 
-#     def get_relevant_definitions(self, user_content, user_content_embedding, threshold):
-#     def cap_rag_section_token_length(self, relevant_sections, capped_number_of_tokens):
-#     def get_relevant_sections(self, user_content, user_content_embedding, threshold, rerank_algo = RerankAlgos.NONE):
-#     def get_relevant_workflow(self, user_content_embedding, threshold):
+    def get_headings(self, relevant_sections):
+        """
+        Returns a Series, aligned with relevant_sections, with the heading of each row. relevant_sections needs the
+        'document' and 'section_reference' columns used in the index. Headings are looked up once per document
+        for the whole batch.
+        """
+        headings = pd.Series("", index = relevant_sections.index, dtype = object)
+        for document_key, document_sections in relevant_sections.groupby("document", sort = False):
+            headings.loc[document_sections.index] = self.corpus.get_headings(document_key, document_sections["section_reference"].to_list())
+        return headings
 
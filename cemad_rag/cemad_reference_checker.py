@@ -1,18 +1,112 @@
+import functools
+import re
+import pandas as pd
 from regulations_rag.reference_checker import ReferenceChecker
 
 
 class CEMADReferenceChecker(ReferenceChecker):
+    """
+    The six index patterns are combined into one compiled pattern, with one named group per level where each level
+    can only be present if the level before it is, so a reference is split into its components with a single
+    fullmatch. The components and ancestors of the most recently used references are memoized (up to
+    MEMOIZED_REFERENCES of each) because get_text, get_heading and the table of content ask for the same references
+    over and over.
+
+    References that do not match the combined pattern (e.g. the ones on the exclusion list) are passed to the
+    generic ReferenceChecker so the answers do not change.
+    """
+    # More than the number of distinct references in the documents
+    MEMOIZED_REFERENCES = 8192
+
+    EXCLUSION_LIST = ['Legal context', 'Introduction']
+    INDEX_PATTERNS = [
+        r'^[A-Z]\.\d{0,2}',             # Matches capital letter followed by a period and up to two digits.
+        r'^\([A-Z]\)',                  # Matches single capital letters within parentheses.
+        r'^\((i|ii|iii|iv|v|vi|vii|viii|ix|x|xi|xii|xiii|xiv|xv|xvi|xvii|xviii|xix|xx|xxi|xxii|xxiii|xxiv|xxv|xxvi|xxvii)\)', # Matches Roman numerals within parentheses.
+        r'^\([a-z]\)',                  # Matches single lowercase letters within parentheses.
+        r'^\([a-z]{2}\)',               # Matches two lowercase letters within parentheses.
+        r'^\((?:[1-9]|[1-9][0-9])\)',   # Matches numbers within parentheses, excluding leading zeros.
+    ]
+    TEXT_PATTERN = r"[A-Z]\.\d{0,2}(?:\([A-Z]\))?(?:\((?:i|ii|iii|iv|v|vi)\))?(?:\([a-z]\))?(?:\([a-z]{2}\))?(?:\(\d+\))?"
+
     def __init__(self):
-        cemad_exclusion_list = ['Legal context', 'Introduction']
-        cemad_index_patterns = [
-            r'^[A-Z]\.\d{0,2}',             # Matches capital letter followed by a period and up to two digits.
-            r'^\([A-Z]\)',                  # Matches single capital letters within parentheses.
-            r'^\((i|ii|iii|iv|v|vi|vii|viii|ix|x|xi|xii|xiii|xiv|xv|xvi|xvii|xviii|xix|xx|xxi|xxii|xxiii|xxiv|xxv|xxvi|xxvii)\)', # Matches Roman numerals within parentheses.
-            r'^\([a-z]\)',                  # Matches single lowercase letters within parentheses.
-            r'^\([a-z]{2}\)',               # Matches two lowercase letters within parentheses.
-            r'^\((?:[1-9]|[1-9][0-9])\)',   # Matches numbers within parentheses, excluding leading zeros.
-        ]    
-        text_pattern = r"[A-Z]\.\d{0,2}(?:\([A-Z]\))?(?:\((?:i|ii|iii|iv|v|vi)\))?(?:\([a-z]\))?(?:\([a-z]{2}\))?(?:\(\d+\))?"
+        cemad_exclusion_list = self.EXCLUSION_LIST
+        cemad_index_patterns = self.INDEX_PATTERNS
+        text_pattern = self.TEXT_PATTERN
 
         super().__init__(regex_list_of_indices = cemad_index_patterns, text_version = text_pattern, exclusion_list=cemad_exclusion_list)
 
+        # (?P<level0>A)(?:(?P<level1>B)(?:(?P<level2>C)...)?)?
+        nested_levels = ""
+        for level in reversed(range(1, len(cemad_index_patterns))):
+            nested_levels = f"(?:(?P<level{level}>{cemad_index_patterns[level].lstrip('^')}){nested_levels})?"
+        self.compiled_reference_pattern = re.compile(f"(?P<level0>{cemad_index_patterns[0].lstrip('^')}){nested_levels}")
+        self.level_names = [f"level{level}" for level in range(len(cemad_index_patterns))]
+        self.compiled_text_version = re.compile(text_pattern)
+        # not preceded by a letter, digit or '.' and not followed by a letter or digit, so neither 'U.S.' nor 'e.g.'
+        # produce references. An initial on its own (e.g. the 'J.' of 'J. Smith') still does
+        self.compiled_text_pattern = re.compile(r"(?<![A-Za-z0-9.])" + text_pattern + r"(?![A-Za-z0-9])")
+
+        # bounded per instance memos. The references are strings (or NaN) so they can be the keys
+        self._get_components = functools.lru_cache(maxsize = self.MEMOIZED_REFERENCES)(self._parse_components)
+        self._get_ancestors = functools.lru_cache(maxsize = self.MEMOIZED_REFERENCES)(self._find_ancestors)
+
+    def _parse_components(self, reference):
+        ''' The components of the reference as a tuple, or None if it does not match the combined pattern '''
+        match = self.compiled_reference_pattern.fullmatch(reference) if isinstance(reference, str) else None
+        if match is None:
+            return None
+        return tuple(component for component in match.group(*self.level_names) if component is not None)
+
+    def is_valid(self, reference):
+        if self._get_components(reference) is not None:
+            return True
+        return super().is_valid(reference)
+
+    def split_reference(self, reference):
+        components = self._get_components(reference)
+        if components is None:
+            return super().split_reference(reference)
+        return list(components)
+
+    def get_parent_reference(self, reference):
+        components = self._get_components(reference)
+        if components is None:
+            return super().get_parent_reference(reference)
+        return "".join(components[:-1])
+
+    def get_ancestors(self, reference):
+        ''' The chain of parent references, starting with the immediate parent and ending at the root of the reference '''
+        return self._get_ancestors(reference)
+
+    def _find_ancestors(self, reference):
+        components = self._get_components(reference)
+        if components is not None:
+            return tuple("".join(components[:level]) for level in range(len(components) - 1, 0, -1))
+        ancestors = []
+        parent_reference = super().get_parent_reference(reference)
+        while parent_reference != "":
+            ancestors.append(parent_reference)
+            parent_reference = self.get_parent_reference(parent_reference)
+        return tuple(ancestors)
+
+    def extract_valid_reference(self, text):
+        ''' The first match of the text pattern in text if it is a valid reference, otherwise None (a later match is not tried) '''
+        match = self.compiled_text_version.search(text)
+        if match is not None and self.is_valid(match.group()):
+            return match.group()
+        return None
+
+    def extract_valid_references(self, text):
+        ''' Every distinct valid reference in text, in the order they first appear '''
+        references = []
+        for match in self.compiled_text_pattern.finditer(text):
+            reference = match.group()
+            if reference not in references and self.is_valid(reference):
+                references.append(reference)
+        return references
+
+    def extract_references(self, texts):
+        ''' texts: a pandas Series of strings. Returns a Series with the list of distinct valid references in each text '''
+        return pd.Series([[reference for reference in dict.fromkeys(self.compiled_text_pattern.findall(text)) if self.is_valid(reference)] for text in texts],
+                         index = texts.index, dtype = object)
@@ -2,9 +2,13 @@ from enum import Enum
 from regulations_rag.corpus_chat import CorpusChat
 from regulations_rag.rerank import RerankAlgos, rerank
 from regulations_rag.embeddings import get_ada_embedding
-from regulations_rag.data_classes import NoAnswerResponse, NoAnswerClassification
+from regulations_rag.data_classes import NoAnswerResponse, NoAnswerClassification, AnswerWithRAGResponse
+from openai import OpenAIError
 from regulations_rag.path_search import PathSearch
 from cemad_rag.path_suggest_alternatives import PathSuggestAlternatives
+from cemad_rag.path_search_cemad import PathSearchCEMAD
+from cemad_rag.embedding_cache import EmbeddingCache, CachedEmbeddingsClient
+from cemad_rag.pipeline_config import PipelineConfig, install_llm_rerank_params, use_pipeline_config
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,15 +27,108 @@ class CorpusChatCEMAD(CorpusChat):
                  chat_parameters,
                  corpus_index,
                  rerank_algo = RerankAlgos.NONE,   
-                 user_name_for_logging = 'test_user'): 
+                 user_name_for_logging = 'test_user',
+                 pipeline_config = None,
+                 lexical_only = False,
+                 embedding_timeout = None,
+                 cross_reference_token_budget = 0,
+                 answer_cache = None): 
+        '''
+            lexical_only, embedding_timeout: if the corpus_index was built with lexical_search, questions are searched
+                                             by keyword when lexical_only is True or when the question cannot be
+                                             embedded within embedding_timeout seconds. See PathSearchCEMAD
+            cross_reference_token_budget: if greater than 0 and the corpus_index has a cross reference graph, the
+                                          sections found for each question are expanded with the sections they
+                                          refer to, using up to this many tokens. There are no extra embedding calls
+            answer_cache: optional AnswerCache, shared by all the sessions. In strict RAG mode, a question asked at
+                          the start of a conversation is answered from the cache if a near identical question has
+                          already been answered, without a search, rerank or chat call
+            pipeline_config: optional PipelineConfig, usually shared by all the sessions. If supplied it provides the
+                             openai client and, during this session's turns, the parameters for RerankAlgos.LLM
+        '''
+        self.pipeline_config = pipeline_config
+        if pipeline_config is not None:
+            chat_parameters.openai_client = pipeline_config.openai_client
+            if rerank_algo == RerankAlgos.LLM:
+                install_llm_rerank_params()
+        if not isinstance(chat_parameters.openai_client, CachedEmbeddingsClient):
+            # PathSearchCEMAD and the wrapped PathSearch can both embed the question (e.g. with a lexical index
+            # or a question that refers to sections directly)
+            chat_parameters.openai_client = CachedEmbeddingsClient(chat_parameters.openai_client, EmbeddingCache(max_size = 256))
         super().__init__(embedding_parameters, chat_parameters, corpus_index, rerank_algo, user_name_for_logging)
+        self.answer_cache = answer_cache
+        self.path_search = PathSearchCEMAD(path_search = self.path_search,
+                                           corpus_index = self.index,
+                                           chat_parameters = self.chat_parameters,
+                                           embedding_parameters = self.embedding_parameters,
+                                           rerank_algo = self.rerank_algo,
+                                           lexical_only = lexical_only,
+                                           embedding_timeout = embedding_timeout,
+                                           cross_reference_token_budget = cross_reference_token_budget,
+                                           final_token_cap = pipeline_config.final_token_cap if pipeline_config is not None else PipelineConfig.final_token_cap)
         self.path_suggest_alternatives = self._create_path_suggest_alternatives()
 
+    def _can_use_answer_cache(self):
+        ''' Only stand alone questions can use the cache. With a conversation history the answer depends on more than the question '''
+        return (self.answer_cache is not None
+                and self.strict_rag
+                and self.system_state == CorpusChat.State.RAG
+                and len(self.messages_intermediate) == 0
+                and not self.path_search.lexical_only)
+
+    def _get_answer_cache_version(self):
+        ''' The cached answers depend on the documents, the index input files (and the token counts) and the chat model '''
+        chat_model = self.pipeline_config.chat_model if self.pipeline_config is not None else getattr(self.chat_parameters, "model", None)
+        return f"{self.index.corpus.version}:{self.index.snapshot_key}:{chat_model}"
+
+    def user_provides_input(self, user_content):
+        # the LLM reranker reads the parameters of this session's pipeline_config
+        with use_pipeline_config(self.pipeline_config):
+            return self._user_provides_input(user_content)
+
+    def _user_provides_input(self, user_content):
+        if not self._can_use_answer_cache():
+            return super().user_provides_input(user_content)
+        # The answer depends on the sections cited, which barely move the embedding ('B.4' and 'B.5'), and these
+        # questions are answered without a search anyway. Checked first so they are not embedded for the cache
+        direct_reference_sections, too_long_references = self.index.get_direct_reference_sections(user_content)
+        if len(direct_reference_sections) > 0 or too_long_references:
+            return super().user_provides_input(user_content)
+
+        try:
+            # the embedding cache makes this the only call to embed the question
+            question_embedding = self.path_search.get_question_embedding(user_content)
+        except OpenAIError as e:
+            logger.warning(f"{self.user_name}: Unable to embed the question for the answer cache ({e})")
+            return super().user_provides_input(user_content)
+        corpus_version = self._get_answer_cache_version()
+
+        cached_messages = self.answer_cache.get(corpus_version, question_embedding)
+        if cached_messages is not None:
+            logger.log(ANALYSIS_LEVEL, f"{self.user_name}: Answered from the answer cache. {self.answer_cache.stats()}")
+            for message in cached_messages:
+                if message.get("role") == "user":
+                    message["content"] = user_content
+            self.messages_intermediate.extend(cached_messages)
+            return
+
+        number_of_messages = len(self.messages_intermediate)
+        super().user_provides_input(user_content)
+        # store everything the turn added, but only if it ended with an answer from the references
+        new_messages = self.messages_intermediate[number_of_messages:]
+        if new_messages and isinstance(new_messages[-1].get("assistant_response"), AnswerWithRAGResponse):
+            self.answer_cache.put(corpus_version, question_embedding, new_messages)
+
+    def set_progress_callback(self, progress_callback):
+        super().set_progress_callback(progress_callback)
+        self.path_search.progress_callback = progress_callback
+
     def _create_path_suggest_alternatives(self):
         return PathSuggestAlternatives(chat_parameters = self.chat_parameters, 
                                      corpus_index = self.index, 
                          embedding_parameters = self.embedding_parameters, 
-                         rerank_algo = self.rerank_algo)
+                         rerank_algo = self.rerank_algo,
+                         pipeline_config = self.pipeline_config)
 
 
 
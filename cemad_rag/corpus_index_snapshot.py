@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import pyarrow.feather as feather
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+# Increase this when the content of the snapshot changes so that older snapshots are ignored
+SNAPSHOT_FORMAT_VERSION = "3"
+# The name of a snapshot folder (see get_snapshot_key). Other files and folders in the snapshot_folder are never removed
+SNAPSHOT_KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+# A temporary folder older than this was left behind by a process that stopped while it was writing a snapshot
+STALE_TEMPORARY_FOLDER_SECONDS = 3600
+
+'''
+A snapshot is a folder with one uncompressed Arrow IPC (Feather v2) file per DataFrame. A cold start reads these
+files instead of decrypting the parquet files, concatenating the index and parsing the csv files again. The tables
+are converted to pandas when they are loaded so the DataFrames are held in memory as usual (the files are only
+memory mapped while they are read).
+
+NOTE: The snapshot contains the decrypted index so the snapshot_folder must be as private as the decryption key.
+'''
+
+def get_snapshot_key(input_files, decryption_key, settings = ""):
+    '''
+        A hash of the content of all the input files, the decryption key and any settings that change the content of
+        the snapshot (e.g. the model used for the token counts). Any change gives a new snapshot
+    '''
+    snapshot_key = hashlib.sha256()
+    snapshot_key.update(SNAPSHOT_FORMAT_VERSION.encode("utf-8"))
+    snapshot_key.update(str(settings).encode("utf-8"))
+    snapshot_key.update(hashlib.sha256(str(decryption_key).encode("utf-8")).digest())
+    for filepath in input_files:
+        snapshot_key.update(os.path.basename(filepath).encode("utf-8"))
+        with open(filepath, "rb") as file:
+            snapshot_key.update(hashlib.sha256(file.read()).digest())
+    return snapshot_key.hexdigest()
+
+
+def load_snapshot(snapshot_folder, snapshot_key):
+    ''' Returns a dictionary of name -> DataFrame or None if there is no snapshot for this key '''
+    folder = os.path.join(snapshot_folder, snapshot_key)
+    if not os.path.isdir(folder):
+        return None
+    frames = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".arrow"):
+            table = feather.read_table(os.path.join(folder, filename), memory_map = True)
+            frames[filename[:-len(".arrow")]] = table.to_pandas()
+    logger.log(ANALYSIS_LEVEL, f"Loaded corpus index snapshot {snapshot_key}")
+    return frames
+
+
+def save_snapshot(snapshot_folder, snapshot_key, frames):
+    ''' Writes the dictionary of name -> DataFrame and removes any snapshots with a different key '''
+    os.makedirs(snapshot_folder, exist_ok = True)
+    folder = os.path.join(snapshot_folder, snapshot_key)
+    if os.path.isdir(folder):
+        return
+
+    # Write to a temporary folder and rename it so another process never sees a half written snapshot
+    temporary_folder = tempfile.mkdtemp(dir = snapshot_folder, prefix = ".tmp_")
+    try:
+        for name, df in frames.items():
+            feather.write_feather(df.reset_index(drop = True), os.path.join(temporary_folder, name + ".arrow"), compression = "uncompressed")
+        os.rename(temporary_folder, folder)
+    except Exception as e:
+        logger.warning(f"Unable to save the corpus index snapshot: {e}")
+        shutil.rmtree(temporary_folder, ignore_errors = True)
+        return
+
+    logger.log(ANALYSIS_LEVEL, f"Saved corpus index snapshot {snapshot_key}")
+    _remove_old_snapshots(snapshot_folder, snapshot_key)
+
+
+def _remove_old_snapshots(snapshot_folder, snapshot_key):
+    ''' Removes the snapshots with a different key and stale temporary folders. Nothing else in snapshot_folder is touched '''
+    for name in os.listdir(snapshot_folder):
+        path = os.path.join(snapshot_folder, name)
+        if name == snapshot_key or os.path.islink(path) or not os.path.isdir(path):
+            continue
+        if SNAPSHOT_KEY_PATTERN.fullmatch(name):
+            shutil.rmtree(path, ignore_errors = True)
+            logger.log(DEV_LEVEL, f"Removed the old corpus index snapshot {name}")
+        elif name.startswith(".tmp_") and time.time() - os.path.getmtime(path) > STALE_TEMPORARY_FOLDER_SECONDS:
+            shutil.rmtree(path, ignore_errors = True)
+            logger.log(DEV_LEVEL, f"Removed the stale temporary snapshot folder {name}")
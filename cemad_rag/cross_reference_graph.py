@@ -0,0 +1,148 @@
+import logging
+from bisect import bisect_left
+
+import pandas as pd
+
+from cemad_rag.token_counter import TokenCounter
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class CrossReferenceGraph:
+    """
+    The references from the sections of the manual to other sections (e.g. "... in terms of section B.2(B) ...").
+
+    Each edge is (document, section_reference) -> (referenced_document, referenced_section_reference) where
+    section_reference is the section of the row in document_as_df that contains the reference. The number of tokens
+    in the text of the referenced section is stored with the edge so the sections can be added to the RAG data within
+    a token budget without rendering or counting anything at query time.
+
+    The graph is built offline (python -m cemad_rag.cross_reference_graph or
+    CEMADCorpusIndex.build_cross_reference_graph) and saved as a parquet file next to the index.
+
+    Whether one section is within another is decided by the components of their references (see is_within) so
+    'B.10' is not part of 'B.1'.
+    """
+    COLUMNS = ["document", "section_reference", "referenced_document", "referenced_section_reference", "referenced_token_count"]
+
+    def __init__(self, edges, corpus):
+        self.edges = edges
+        self.corpus = corpus
+        self._targets = {}
+        for document_key, section_reference, referenced_document, referenced_section_reference, referenced_token_count in edges[self.COLUMNS].itertuples(index = False):
+            self._targets.setdefault((document_key, section_reference), []).append((referenced_document, referenced_section_reference, int(referenced_token_count)))
+        # sorted so all the sources in the subtree of a section can be found with two bisects
+        self._sorted_sources = {}
+        for document_key, section_reference in self._targets:
+            self._sorted_sources.setdefault(document_key, []).append(section_reference)
+        for sources in self._sorted_sources.values():
+            sources.sort()
+
+    @classmethod
+    def build(cls, corpus, token_counter = None):
+        '''
+            Scans every row of every document in the corpus for references. A reference is linked to the same document
+            if it is in that document, otherwise to the primary document. References to a section that contains the
+            row, to sections that are not in the document, or to whole chapters are ignored. The tokens are counted
+            with token_counter (the index's TokenCounter, or one for gpt-4o)
+        '''
+        token_counter = token_counter if token_counter is not None else TokenCounter()
+        primary_document_key = corpus.get_primary_document()
+        token_counts = {}
+        edges = []
+        for document_key in corpus.document_keys:
+            document = corpus.get_document(document_key)
+            document_as_df = document.document_as_df
+            references_in_rows = document.reference_checker.extract_references(document_as_df["text"])
+            for section_reference, referenced_section_references in zip(document_as_df["section_reference"], references_in_rows):
+                for referenced_section_reference in referenced_section_references:
+                    if cls.is_within(document.reference_checker, section_reference, referenced_section_reference) or "(" not in referenced_section_reference and not any(character.isdigit() for character in referenced_section_reference):
+                        continue
+                    for referenced_document in dict.fromkeys([document_key, primary_document_key]):
+                        if referenced_document in corpus.document_keys:
+                            key = (referenced_document, referenced_section_reference)
+                            if key not in token_counts:
+                                text = corpus.get_document(referenced_document).section_renderer.render(referenced_section_reference, add_markdown_decorators = False)
+                                token_counts[key] = None if text is None else token_counter.count(text)
+                            if token_counts[key] is not None:
+                                edges.append((document_key, section_reference, referenced_document, referenced_section_reference, token_counts[key]))
+                                break
+        edges = pd.DataFrame(edges, columns = cls.COLUMNS).drop_duplicates(ignore_index = True)
+        logger.log(ANALYSIS_LEVEL, f"Built a cross reference graph with {len(edges)} edges")
+        return cls(edges, corpus)
+
+    def save(self, filepath):
+        self.edges.to_parquet(filepath, engine = "pyarrow", index = False)
+
+    @classmethod
+    def load(cls, filepath, corpus):
+        return cls(pd.read_parquet(filepath, engine = "pyarrow"), corpus)
+
+    @staticmethod
+    def is_within(reference_checker, section_reference, containing_reference):
+        ''' True if section_reference is containing_reference or one of its subsections, comparing their components '''
+        if not section_reference.startswith(containing_reference):
+            return False
+        if section_reference == containing_reference:
+            return True
+        if not (reference_checker.is_valid(section_reference) and reference_checker.is_valid(containing_reference)):
+            return False
+        containing_components = reference_checker.split_reference(containing_reference)
+        return reference_checker.split_reference(section_reference)[:len(containing_components)] == containing_components
+
+    def _is_within(self, document_key, section_reference, containing_reference):
+        return self.is_within(self.corpus.get_document(document_key).reference_checker, section_reference, containing_reference)
+
+    def get_referenced_sections(self, document_key, section_reference):
+        '''
+            (referenced_document, referenced_section_reference, referenced_token_count) for every reference made in
+            the section or any of its subsections (the text of a section includes its subsections)
+        '''
+        sources = self._sorted_sources.get(document_key, [])
+        # the references that start with section_reference, of which only some are subsections (e.g. not 'B.10' of 'B.1')
+        start = bisect_left(sources, section_reference)
+        end = bisect_left(sources, section_reference + '\U0010ffff', lo = start)
+        referenced_sections = []
+        for source in sources[start:end]:
+            if self._is_within(document_key, source, section_reference):
+                referenced_sections.extend(self._targets[(document_key, source)])
+        return referenced_sections
+
+    def get_one_hop_sections(self, sections, token_budget):
+        '''
+            sections: (document, section_reference) pairs that are already in the RAG data. Returns the
+            (document, section_reference) pairs they refer to that are not already covered, most referred to first,
+            keeping the total referenced_token_count within token_budget
+        '''
+        sections = list(sections)
+        counts = {}
+        token_counts = {}
+        for document_key, section_reference in sections:
+            for referenced_document, referenced_section_reference, referenced_token_count in self.get_referenced_sections(document_key, section_reference):
+                key = (referenced_document, referenced_section_reference)
+                counts[key] = counts.get(key, 0) + 1
+                token_counts[key] = referenced_token_count
+
+        one_hop_sections = []
+        tokens_used = 0
+        for key in sorted(counts, key = lambda key: -counts[key]):
+            # skip sections that are already included, as a whole or as part of a larger section
+            if any(key[0] == document_key and self._is_within(document_key, key[1], section_reference) for document_key, section_reference in sections + one_hop_sections):
+                continue
+            if tokens_used + token_counts[key] > token_budget:
+                continue
+            one_hop_sections.append(key)
+            tokens_used += token_counts[key]
+        return one_hop_sections
+
+
+if __name__ == "__main__":
+    # Builds the graph for the documents and saves it next to the index. The file is not committed: deploy() builds
+    # it, or run this from the root of the repository: python -m cemad_rag.cross_reference_graph
+    from cemad_rag.cemad_corpus import CEMADCorpus
+    logging.basicConfig(level = ANALYSIS_LEVEL)
+    CrossReferenceGraph.build(CEMADCorpus("./cemad_rag/documents/")).save("./inputs/index/cross_references.parquet")
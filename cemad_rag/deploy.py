@@ -1,6 +1,9 @@
 import shutil
 import os
 
+from cemad_rag.cemad_corpus import CEMADCorpus
+from cemad_rag.cross_reference_graph import CrossReferenceGraph
+
 
 
 def deploy(base_folder):
@@ -10,6 +13,10 @@ def deploy(base_folder):
     ''' 
     destination = "e:/code/chat/cemad_rag"
 
+    # The cross reference graph is not committed. It is built here, with the installed regulations_rag, so it always
+    # matches the documents and the parser that are deployed
+    CrossReferenceGraph.build(CEMADCorpus(base_folder + "/cemad_rag/documents/")).save(base_folder + "/inputs/index/cross_references.parquet")
+
     items_to_copy = [base_folder + "/cemad_rag/",
                      base_folder + "/.gitignore",
                      base_folder + "/app.py",
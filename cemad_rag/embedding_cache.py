@@ -0,0 +1,149 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from openai import NOT_GIVEN
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class EmbeddingCache:
+    """
+    A two tier cache of embeddings keyed by (model, dimensions, normalised text).
+
+    The first tier is an in-memory LRU shared by every session in the process. The optional second tier is a
+    SQLite database (database_path) so embeddings survive restarts and can be shared by the worker processes on
+    the same machine. Embeddings are stored as float64 so a cached embedding is identical to the one the API
+    returned, i.e. about 8 KB per 1024 dimension embedding. The database keeps at most max_database_size rows: when
+    a put takes it over, the rows that were least recently written or read from the database are deleted.
+    """
+    def __init__(self, max_size = 4096, database_path = None, max_database_size = 20000):
+        self.max_size = max_size
+        self.max_database_size = max_database_size
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._database = None
+        if database_path is not None:
+            self._database = sqlite3.connect(database_path, check_same_thread = False)
+            self._database.execute("PRAGMA journal_mode=WAL")
+            self._database.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, dimensions INTEGER, text TEXT, embedding BLOB, last_used REAL, PRIMARY KEY (model, dimensions, text))")
+            columns = [column[1] for column in self._database.execute("PRAGMA table_info(embeddings)")]
+            if "last_used" not in columns:
+                # a database from before the pruning. Its rows are the first to go
+                self._database.execute("ALTER TABLE embeddings ADD COLUMN last_used REAL DEFAULT 0")
+            self._database.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._database.commit()
+
+    @staticmethod
+    def normalise_text(text):
+        ''' Collapses all whitespace so trivially different versions of the same question share an embedding '''
+        return " ".join(text.split())
+
+    def get(self, model, dimensions, text):
+        ''' Returns the embedding as a list of floats or None '''
+        key = (model, dimensions, self.normalise_text(text))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+            if self._database is not None:
+                row = self._database.execute("SELECT embedding FROM embeddings WHERE model = ? AND dimensions = ? AND text = ?", key).fetchone()
+                if row is not None:
+                    self._database.execute("UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text = ?", (time.time(),) + key)
+                    self._database.commit()
+                    embedding = np.frombuffer(row[0], dtype = np.float64).tolist()
+                    self._add_to_memory(key, embedding)
+                    self.database_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, model, dimensions, text, embedding):
+        key = (model, dimensions, self.normalise_text(text))
+        embedding = list(embedding)
+        with self._lock:
+            self._add_to_memory(key, embedding)
+            if self._database is not None:
+                self._database.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", key + (np.asarray(embedding, dtype = np.float64).tobytes(), time.time()))
+                self._prune_database()
+                self._database.commit()
+
+    def _prune_database(self):
+        ''' Deletes the least recently used rows over max_database_size. Counted on every put because other processes may share the database '''
+        number_of_rows = self._database.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if number_of_rows > self.max_database_size:
+            self._database.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (number_of_rows - self.max_database_size,))
+            logger.log(DEV_LEVEL, f"Deleted {number_of_rows - self.max_database_size} embeddings from the cache database")
+
+    def _add_to_memory(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last = False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.database_hits + self.misses
+            return {"memory_hits": self.memory_hits,
+                    "database_hits": self.database_hits,
+                    "misses": self.misses,
+                    "hit_rate": (self.memory_hits + self.database_hits) / lookups if lookups > 0 else 0.0,
+                    "size": len(self._entries),
+                    "max_size": self.max_size}
+
+
+class CachedEmbeddings:
+    """ A stand in for the 'embeddings' resource of an OpenAI client that only sends the texts it has not seen before """
+    def __init__(self, embeddings, embedding_cache):
+        self._embeddings = embeddings
+        self.embedding_cache = embedding_cache
+
+    def create(self, *, input, model, dimensions = NOT_GIVEN, encoding_format = NOT_GIVEN, **kwargs):
+        # Only plain text, float encoded requests are cached
+        texts = [input] if isinstance(input, str) else input
+        if encoding_format not in (NOT_GIVEN, "float") or not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return self._embeddings.create(input = input, model = model, dimensions = dimensions, encoding_format = encoding_format, **kwargs)
+
+        cache_dimensions = dimensions if dimensions is not NOT_GIVEN else 0
+        embeddings = [self.embedding_cache.get(model, cache_dimensions, text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        usage = Usage(prompt_tokens = 0, total_tokens = 0)
+        if missing:
+            response = self._embeddings.create(input = [texts[i] for i in missing], model = model, dimensions = dimensions, **kwargs)
+            for i, data in zip(missing, sorted(response.data, key = lambda data: data.index)):
+                embeddings[i] = data.embedding
+                self.embedding_cache.put(model, cache_dimensions, texts[i], data.embedding)
+            usage = response.usage
+        logger.log(DEV_LEVEL, f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} texts from the cache. {self.embedding_cache.stats()}")
+
+        return CreateEmbeddingResponse(data = [Embedding(embedding = embedding, index = i, object = "embedding") for i, embedding in enumerate(embeddings)],
+                                       model = model,
+                                       object = "list",
+                                       usage = usage)
+
+
+class CachedEmbeddingsClient:
+    """
+    Wraps an OpenAI client so every embeddings.create call, including the ones made inside regulations_rag via
+    get_ada_embedding, goes through an EmbeddingCache. Everything else is passed straight to the wrapped client.
+    """
+    def __init__(self, openai_client, embedding_cache):
+        self.openai_client = openai_client
+        self.embeddings = CachedEmbeddings(openai_client.embeddings, embedding_cache)
+
+    def __getattr__(self, name):
+        return getattr(self.openai_client, name)
@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class EmbeddingMatrix:
+    """
+    The embeddings from one column of a DataFrame held as a single C-contiguous matrix with unit length rows so
+    that the cosine distance to every row is one BLAS matrix-vector product.
+
+    get_closest_nodes returns the same DataFrame as regulations_rag.embeddings.get_closest_nodes (the matching
+    rows plus a 'cosine_distance' column, sorted by distance) but only the matching rows are ever copied.
+
+    precision:
+    - "float32": the matrix is held in memory as float32 and the distances are exact.
+    - "float16" or "int8": only a quantized copy of the matrix is held in memory. The first pass over the quantized
+      matrix selects candidates (with a margin for the quantization error) which are then scored exactly using the
+      float32 matrix, memory mapped from exact_store_folder so only the pages for the candidates are read. The
+      embedding column is dropped from self.df and added back (from the float32 matrix) to the rows returned.
+    """
+    PRECISIONS = ["float32", "float16", "int8"]
+    # Upper bound on the error in the cosine distance from the first, quantized, pass
+    QUANTIZATION_MARGIN = {"float32": 0.0, "float16": 0.002, "int8": 0.02}
+    # Rows are scaled back to float32 in blocks of this size to bound the temporary memory used by the first pass
+    BLOCK_SIZE = 8192
+    # Tables with fewer rows than this are always searched exactly, even if they have an approximate index
+    EXACT_SEARCH_BELOW = 2000
+
+    def __init__(self, df, embedding_column_name = "embedding", precision = "float32", exact_store_folder = None):
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"precision must be one of {self.PRECISIONS}, not {precision}")
+        self.embedding_column_name = embedding_column_name
+        self.precision = precision
+
+        if len(df) == 0:
+            exact_matrix = np.empty((0, 0), dtype = np.float32)
+        else:
+            exact_matrix = self.normalise(np.vstack(df[embedding_column_name].to_numpy()))
+        self.fingerprint = hashlib.sha256(exact_matrix.tobytes()).hexdigest()
+        self.ann_index = None
+        self.number_of_probes = None
+
+        if precision == "float32":
+            self.df = df
+            self.matrix = exact_matrix
+            self.exact_matrix = exact_matrix
+            self.scale = None
+        else:
+            self.df = df.drop(columns = [embedding_column_name])
+            if precision == "float16":
+                self.matrix = exact_matrix.astype(np.float16)
+                self.scale = None
+            else:
+                # symmetric per row quantization: row ~ int8 row * scale
+                max_abs = np.abs(exact_matrix).max(axis = 1, initial = 0.0)
+                max_abs[max_abs == 0] = 1.0
+                self.scale = (max_abs / 127.0).astype(np.float32)
+                self.matrix = np.round(exact_matrix / self.scale[:, np.newaxis]).astype(np.int8)
+            self.exact_matrix = self._memory_map_exact_matrix(exact_matrix, exact_store_folder)
+
+    def _memory_map_exact_matrix(self, exact_matrix, exact_store_folder):
+        if exact_store_folder is None:
+            exact_store_folder = os.path.join(tempfile.gettempdir(), "cemad_rag_embeddings")
+        os.makedirs(exact_store_folder, exist_ok = True)
+        filepath = os.path.join(exact_store_folder, self.fingerprint + f"_{exact_matrix.shape[0]}x{exact_matrix.shape[1]}.npy")
+        if not os.path.exists(filepath):
+            temporary_filepath = filepath + f".{os.getpid()}.tmp"
+            with open(temporary_filepath, "wb") as file:
+                np.save(file, exact_matrix)
+            os.replace(temporary_filepath, filepath)
+        return np.load(filepath, mmap_mode = "r")
+
+    @staticmethod
+    def normalise(embeddings):
+        embeddings = np.array(embeddings, dtype = np.float32, order = "C", ndmin = 2)
+        norms = np.linalg.norm(embeddings, axis = 1, keepdims = True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+        return embeddings
+
+    def set_ann_index(self, ann_index, number_of_probes):
+        '''
+            Use an approximate index (e.g. an IVFIndex) to choose the rows that are scored. Returns False, and keeps
+            using exact search, if the approximate index was not built from this matrix. number_of_probes is at least 1
+        '''
+        if ann_index.fingerprint != self.fingerprint:
+            return False
+        if int(number_of_probes) < 1:
+            logger.warning(f"number_of_probes must be at least 1, not {number_of_probes}. Using 1")
+        number_of_probes = max(1, int(number_of_probes))
+        self.ann_index = ann_index
+        self.number_of_probes = number_of_probes
+        return True
+
+    def memory_usage(self):
+        ''' Bytes held in memory for the search (the memory mapped float32 matrix is not included for quantized precisions) '''
+        scale_bytes = 0 if self.scale is None else self.scale.nbytes
+        return self.matrix.nbytes + scale_bytes
+
+    def _get_search_rows(self, query):
+        ''' The sorted positions of the rows to score: all of them unless there is an approximate index '''
+        if self.ann_index is None or len(self.df) < self.EXACT_SEARCH_BELOW:
+            return np.arange(len(self.df), dtype = np.intp)
+        return self.ann_index.get_candidate_rows(query, self.number_of_probes)
+
+    def cosine_distances(self, query, rows):
+        '''
+            query: a unit length float32 vector. rows: sorted positions of the rows to score.
+            Exact for float32, approximate (first pass) for the quantized precisions
+        '''
+        matrix = self.matrix if len(rows) == self.matrix.shape[0] else self.matrix[rows]
+        if self.precision == "float32":
+            return 1.0 - matrix @ query
+        similarities = np.empty(matrix.shape[0], dtype = np.float32)
+        for start in range(0, matrix.shape[0], self.BLOCK_SIZE):
+            block = matrix[start:start + self.BLOCK_SIZE].astype(np.float32)
+            similarities[start:start + self.BLOCK_SIZE] = block @ query
+        if self.scale is not None:
+            similarities *= self.scale[rows]
+        return 1.0 - similarities
+
+    def exact_cosine_distances(self, query, rows):
+        ''' rows should be sorted so the reads from the memory mapped matrix are sequential '''
+        return 1.0 - np.asarray(self.exact_matrix[rows]) @ query
+
+    def get_closest_rows(self, content_embedding, threshold, top_k = None):
+        ''' Positions of the rows with a cosine distance below threshold, closest first, and their distances '''
+        if len(self.df) == 0:
+            return np.empty(0, dtype = np.intp), np.empty(0, dtype = np.float32)
+        query = self.normalise(content_embedding)[0]
+        rows = self._get_search_rows(query)
+        distances = self.cosine_distances(query, rows)
+        if self.precision != "float32":
+            margin = self.QUANTIZATION_MARGIN[self.precision]
+            candidates = distances < threshold + margin
+            rows, distances = rows[candidates], distances[candidates]
+            if top_k is not None and len(rows) > top_k:
+                # anything further than the approximate k'th distance plus twice the error cannot be in the top_k
+                kth_distance = np.partition(distances, top_k - 1)[top_k - 1]
+                candidates = distances <= kth_distance + 2 * margin
+                rows = rows[candidates]
+            # re-score the candidates exactly
+            distances = self.exact_cosine_distances(query, rows)
+
+        matches = distances < threshold
+        rows, distances = rows[matches], distances[matches]
+        if top_k is not None and len(rows) > top_k:
+            closest = np.argpartition(distances, top_k - 1)[:top_k]
+            rows, distances = rows[closest], distances[closest]
+        order = np.argsort(distances, kind = "stable")
+        return rows[order], distances[order]
+
+    def get_matches(self, content_embeddings, threshold):
+        '''
+            content_embeddings: one embedding per query. Returns a boolean array (queries x rows) which is True where
+            the row is within threshold of the query. All the queries are scored in one matrix-matrix product over
+            every row, so the approximate index is not used.
+        '''
+        queries = self.normalise(content_embeddings)
+        if len(self.df) == 0:
+            return np.zeros((queries.shape[0], 0), dtype = bool)
+        if self.precision == "float32":
+            return (1.0 - self.matrix @ queries.T).T < threshold
+
+        similarities = np.empty((self.matrix.shape[0], queries.shape[0]), dtype = np.float32)
+        for start in range(0, self.matrix.shape[0], self.BLOCK_SIZE):
+            similarities[start:start + self.BLOCK_SIZE] = self.matrix[start:start + self.BLOCK_SIZE].astype(np.float32) @ queries.T
+        if self.scale is not None:
+            similarities *= self.scale[:, np.newaxis]
+        # re-score exactly the rows that are candidates for any of the queries
+        rows = np.flatnonzero((1.0 - similarities < threshold + self.QUANTIZATION_MARGIN[self.precision]).any(axis = 1))
+        matches = np.zeros((queries.shape[0], self.matrix.shape[0]), dtype = bool)
+        matches[:, rows] = (1.0 - np.asarray(self.exact_matrix[rows]) @ queries.T).T < threshold
+        return matches
+
+    def get_rows_frame(self, rows):
+        ''' The rows of the DataFrame at the positions in rows, including the embedding column (unit length for the quantized precisions) '''
+        rows_frame = self.df.iloc[rows].copy()
+        if self.precision != "float32":
+            rows_frame[self.embedding_column_name] = list(np.asarray(self.exact_matrix[rows], dtype = np.float64))
+        return rows_frame
+
+    def get_closest_nodes(self, content_embedding, threshold, top_k = None):
+        rows, distances = self.get_closest_rows(content_embedding, threshold, top_k)
+        closest_nodes = self.get_rows_frame(rows)
+        closest_nodes["cosine_distance"] = distances.astype(np.float64)
+        return closest_nodes
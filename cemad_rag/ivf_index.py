@@ -0,0 +1,85 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class IVFIndex:
+    """
+    An inverted file (IVF) approximate nearest neighbour index in NumPy.
+
+    The unit length rows of an EmbeddingMatrix are clustered with spherical k-means. Each row is stored in the
+    list of its closest centroid. A query is only scored against the rows in the number_of_probes lists whose
+    centroids are closest to it, so the work per query grows with number_of_probes * (rows / number_of_lists)
+    rather than the number of rows. More probes give better recall and slower queries.
+
+    The index is built offline (see CEMADCorpusIndex.build_ann_indexes) and saved as an .npz file next to the
+    parquet files. The fingerprint of the matrix it was built from is saved with it so a stale index is never used.
+    """
+    def __init__(self, centroids, list_offsets, list_rows, fingerprint):
+        self.centroids = centroids          # (number_of_lists, dimensions), unit length rows
+        self.list_offsets = list_offsets    # rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]]
+        self.list_rows = list_rows
+        self.fingerprint = fingerprint
+
+    @property
+    def number_of_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, embedding_matrix, number_of_lists = None, iterations = 20, seed = 0):
+        ''' embedding_matrix: an EmbeddingMatrix. By default there are about sqrt(rows) lists '''
+        matrix = np.asarray(embedding_matrix.exact_matrix, dtype = np.float32)
+        number_of_rows = matrix.shape[0]
+        if number_of_lists is None:
+            number_of_lists = max(1, int(np.sqrt(number_of_rows)))
+        number_of_lists = min(number_of_lists, number_of_rows)
+
+        random_generator = np.random.default_rng(seed)
+        centroids = matrix[random_generator.choice(number_of_rows, number_of_lists, replace = False)].copy()
+        for _ in range(iterations):
+            assignments = cls._closest_centroids(matrix, centroids)
+            counts = np.bincount(assignments, minlength = number_of_lists)
+            sums = np.zeros_like(centroids)
+            order = np.argsort(assignments, kind = "stable")
+            non_empty_lists = np.flatnonzero(counts)
+            sums[non_empty_lists] = np.add.reduceat(matrix[order], np.cumsum(counts)[non_empty_lists] - counts[non_empty_lists], axis = 0)
+            # restart any empty list at a random row
+            empty_lists = np.flatnonzero(counts == 0)
+            sums[empty_lists] = matrix[random_generator.choice(number_of_rows, len(empty_lists), replace = False)]
+            norms = np.linalg.norm(sums, axis = 1, keepdims = True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        assignments = cls._closest_centroids(matrix, centroids)
+        list_rows = np.argsort(assignments, kind = "stable").astype(np.intp)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength = number_of_lists))]).astype(np.intp)
+        logger.log(ANALYSIS_LEVEL, f"Built an IVF index with {number_of_lists} lists over {number_of_rows} rows")
+        return cls(centroids, list_offsets, list_rows, embedding_matrix.fingerprint)
+
+    @staticmethod
+    def _closest_centroids(matrix, centroids, block_size = 8192):
+        assignments = np.empty(matrix.shape[0], dtype = np.intp)
+        for start in range(0, matrix.shape[0], block_size):
+            assignments[start:start + block_size] = np.argmax(matrix[start:start + block_size] @ centroids.T, axis = 1)
+        return assignments
+
+    def get_candidate_rows(self, query, number_of_probes):
+        ''' query: a unit length float32 vector. Returns the sorted positions of the rows in the closest lists '''
+        number_of_probes = max(1, min(number_of_probes, self.number_of_lists))
+        similarities = self.centroids @ query
+        probed_lists = np.argpartition(-similarities, number_of_probes - 1)[:number_of_probes]
+        return np.sort(np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed_lists]))
+
+    def save(self, filepath):
+        np.savez(filepath, centroids = self.centroids, list_offsets = self.list_offsets, list_rows = self.list_rows, fingerprint = np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"], str(data["fingerprint"]))
@@ -0,0 +1,91 @@
+import logging
+import re
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class BM25Index:
+    """
+    An in-memory Okapi BM25 index over a list of texts (one per row of a table).
+
+    The BM25 weight of every (row, term) pair is computed once when the index is built and held in a sparse
+    column-major matrix, so scoring a query is a sum of the columns for its terms. Tokens keep dotted and
+    hyphenated runs together (e.g. 'b.4', '10-digit') so exact regulatory terms, acronyms ('sda', 'fia') and BOP
+    code numbers ('401') are matched as they are written.
+    """
+    TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+    # Common English words that match nearly every row. They are left out of the index and the queries so a
+    # question like 'what is the ...' does not match everything
+    STOP_WORDS = frozenset("""a about above after again against all am an and any are as at be because been before being
+        below between both but by can could did do does doing down during each few for from further had has have having
+        he her here hers herself him himself his how i if in into is it its itself just me more most my myself no nor
+        not now of off on once only or other our ours ourselves out over own same she should so some such than that the
+        their theirs them themselves then there these they this those through to too under until up very was we were
+        what when where which while who whom why will with would you your yours yourself yourselves""".split())
+
+    def __init__(self, texts, k1 = 1.5, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        rows, columns, counts = [], [], []
+        lengths = np.zeros(len(texts), dtype = np.float32)
+        for row, text in enumerate(texts):
+            tokens = self.tokenize(text)
+            lengths[row] = len(tokens)
+            term_counts = {}
+            for token in tokens:
+                term = self.vocabulary.setdefault(token, len(self.vocabulary))
+                term_counts[term] = term_counts.get(term, 0) + 1
+            rows.extend([row] * len(term_counts))
+            columns.extend(term_counts.keys())
+            counts.extend(term_counts.values())
+
+        term_frequencies = sparse.csr_matrix((np.array(counts, dtype = np.float32), (rows, columns)), shape = (len(texts), len(self.vocabulary)))
+        document_frequencies = np.bincount(np.array(columns, dtype = np.intp), minlength = len(self.vocabulary))
+        idf = np.log(1.0 + (len(texts) - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+
+        average_length = lengths.mean() if len(texts) > 0 else 1.0
+        length_normalisation = k1 * (1.0 - b + b * lengths / max(average_length, 1.0))
+        weights = term_frequencies.tocoo()
+        data = idf[weights.col] * weights.data * (k1 + 1.0) / (weights.data + length_normalisation[weights.row])
+        self.weights = sparse.csc_matrix((data, (weights.row, weights.col)), shape = term_frequencies.shape)
+        logger.log(DEV_LEVEL, f"Built a BM25 index over {len(texts)} rows with {len(self.vocabulary)} terms")
+
+    @classmethod
+    def tokenize(cls, text):
+        return [token for token in cls.TOKEN_PATTERN.findall(str(text).lower()) if token not in cls.STOP_WORDS]
+
+    def get_scores(self, query):
+        ''' The BM25 score of every row for the query '''
+        terms = list({self.vocabulary[token] for token in self.tokenize(query) if token in self.vocabulary})
+        if not terms:
+            return np.zeros(self.weights.shape[0], dtype = np.float32)
+        return np.asarray(self.weights[:, terms].sum(axis = 1)).ravel()
+
+    def get_top_rows(self, query, top_k, minimum_score = 0.0):
+        ''' Positions of the (at most top_k) rows that share a term with the query and score above minimum_score, highest score first, and their scores '''
+        scores = self.get_scores(query)
+        rows = np.flatnonzero(scores > max(minimum_score, 0.0))
+        if len(rows) > top_k:
+            rows = rows[np.argpartition(-scores[rows], top_k - 1)[:top_k]]
+        rows = rows[np.argsort(-scores[rows], kind = "stable")]
+        return rows, scores[rows]
+
+
+def reciprocal_rank_fusion(ranked_lists, k = 60):
+    '''
+        ranked_lists: arrays of row positions, best first. Returns the distinct rows ordered by their reciprocal rank
+        fusion score, sum(1 / (k + rank)), best first
+    '''
+    fused_scores = {}
+    for ranked_rows in ranked_lists:
+        for rank, row in enumerate(ranked_rows):
+            fused_scores[row] = fused_scores.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return np.array(sorted(fused_scores, key = lambda row: -fused_scores[row]), dtype = np.intp)
@@ -0,0 +1,138 @@
+import logging
+import pandas as pd
+from openai import NOT_GIVEN, OpenAIError
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+class PathSearchCEMAD:
+    """
+    Wraps the regulations_rag PathSearch to answer questions that refer to sections directly without a search and
+    to fall back to lexical search when there is no embedding.
+
+    If the question refers to sections of the manual explicitly (e.g. 'what does B.4(B)(ii) say about ...') and
+    does not trigger a workflow, similarity_search returns those sections
+    (CEMADCorpusIndex.get_direct_reference_sections) with the definitions found for the question. There is no
+    section search or rerank, so the sections are capped at final_token_cap tokens here. A referenced section that
+    is too long to use whole is searched for as usual instead.
+
+    If the index was built with lexical_search, a question that cannot be embedded (an error from the embedding
+    service or no response within embedding_timeout seconds) is answered from the BM25 indexes instead, without a
+    rerank. lexical_only does this for every question, e.g. while the embedding service is known to be down.
+
+    With a cross_reference_token_budget, the sections found by any of these are expanded with the sections they
+    refer to, within the budget (see CEMADCorpusIndex.expand_with_cross_references).
+
+    The wrapped PathSearch embeds the question again so the openai client should be a CachedEmbeddingsClient which
+    makes the second call a cache hit.
+    """
+    def __init__(self, path_search, corpus_index, chat_parameters, embedding_parameters, rerank_algo, lexical_only = False, embedding_timeout = None, cross_reference_token_budget = 0, final_token_cap = 5000):
+        self.path_search = path_search
+        self.corpus_index = corpus_index
+        self.chat_parameters = chat_parameters
+        self.embedding_parameters = embedding_parameters
+        self.rerank_algo = rerank_algo
+        self.lexical_only = lexical_only
+        self.embedding_timeout = embedding_timeout
+        self.cross_reference_token_budget = cross_reference_token_budget
+        self.final_token_cap = final_token_cap
+        self.progress_callback = None
+
+    def __getattr__(self, name):
+        return getattr(self.path_search, name)
+
+    def _report_progress(self, status):
+        if self.progress_callback:
+            self.progress_callback(status)
+
+    def similarity_search(self, user_question):
+        workflow_triggered, relevant_definitions, relevant_sections = self._similarity_search(user_question)
+        return workflow_triggered, relevant_definitions, self.add_cross_references(relevant_sections)
+
+    def add_cross_references(self, relevant_sections):
+        if self.cross_reference_token_budget <= 0:
+            return relevant_sections
+        return self.corpus_index.expand_with_cross_references(relevant_sections, self.cross_reference_token_budget)
+
+    def _similarity_search(self, user_question):
+        direct_reference_sections, too_long_references = self.corpus_index.get_direct_reference_sections(user_question)
+        if len(direct_reference_sections) > 0:
+            return self._direct_reference_search(user_question, direct_reference_sections, too_long_references)
+
+        lexical_search_available = self.corpus_index.lexical_indexes is not None
+        if self.lexical_only and lexical_search_available:
+            return self.lexical_search(user_question)
+        if not lexical_search_available:
+            return self.path_search.similarity_search(user_question = user_question)
+
+        try:
+            # with embedding_timeout, so the wrapped PathSearch gets the embedding from the cache
+            self.get_question_embedding(user_question)
+        except OpenAIError as e:
+            logger.warning(f"Unable to embed the question ({e}). Using lexical search")
+            return self.lexical_search(user_question)
+        return self.path_search.similarity_search(user_question = user_question)
+
+    def _direct_reference_search(self, user_question, direct_reference_sections, too_long_references):
+        '''
+            The question refers to sections explicitly. The workflows are still checked first, and the question goes
+            through the usual search if one is triggered. Otherwise the referenced sections are used, without a
+            rerank, with the definitions found for the question. If some of the referenced sections were too long to
+            use whole, the question is also searched as usual and the sections found are added after the referenced
+            ones. The sections are capped at final_token_cap tokens
+        '''
+        question_embedding = None
+        if not self.lexical_only:
+            try:
+                question_embedding = self.get_question_embedding(user_question)
+            except OpenAIError as e:
+                logger.warning(f"Unable to embed the question ({e}). Using the sections referred to in it without a workflow check")
+        if question_embedding is None:
+            workflow_triggered, relevant_definitions, searched_sections = self.corpus_index.get_no_workflow(), self.corpus_index.get_no_definitions(), None
+            if too_long_references and self.corpus_index.lexical_indexes is not None:
+                workflow_triggered, relevant_definitions, searched_sections = self.lexical_search(user_question)
+        else:
+            workflow_triggered = self.corpus_index.get_relevant_workflow(user_content_embedding = question_embedding,
+                                                                         threshold = self.embedding_parameters.threshold_workflow)
+            if workflow_triggered != self.corpus_index.get_no_workflow():
+                return self.path_search.similarity_search(user_question = user_question)
+            if too_long_references:
+                workflow_triggered, relevant_definitions, searched_sections = self.path_search.similarity_search(user_question = user_question)
+            else:
+                relevant_definitions = self.corpus_index.get_relevant_definitions(user_content = user_question,
+                                                                                 user_content_embedding = question_embedding,
+                                                                                 threshold = self.embedding_parameters.threshold_definitions)
+                searched_sections = None
+
+        logger.log(ANALYSIS_LEVEL, f"Using the sections referred to in the question: {direct_reference_sections['section_reference'].to_list()}")
+        if too_long_references:
+            logger.log(ANALYSIS_LEVEL, f"The sections {too_long_references} referred to in the question are too long to use whole. They were searched for instead")
+        self._report_progress("Retrieving the sections referred to in the question ...")
+        relevant_sections = direct_reference_sections
+        if searched_sections is not None and len(searched_sections) > 0:
+            relevant_sections = pd.concat([direct_reference_sections, searched_sections], ignore_index = True)
+            relevant_sections = relevant_sections.drop_duplicates(subset = ["document", "section_reference"])
+        capped_sections = self.corpus_index.cap_rag_section_token_length(relevant_sections, self.final_token_cap)
+        if len(capped_sections) < len(relevant_sections):
+            dropped_references = relevant_sections["section_reference"][~relevant_sections.index.isin(capped_sections.index)].to_list()
+            logger.log(ANALYSIS_LEVEL, f"Dropped the sections {dropped_references} to stay within {self.final_token_cap} tokens")
+        return workflow_triggered, relevant_definitions, capped_sections
+
+    def get_question_embedding(self, user_question):
+        timeout = self.embedding_timeout if self.embedding_timeout is not None else NOT_GIVEN
+        response = self.chat_parameters.openai_client.embeddings.create(input = [user_question.replace("\n", " ")],
+                                                                        model = self.embedding_parameters.model,
+                                                                        dimensions = self.embedding_parameters.dimensions,
+                                                                        timeout = timeout)
+        return response.data[0].embedding
+
+    def lexical_search(self, user_question):
+        ''' Returns the same as PathSearch.similarity_search using only the BM25 indexes. No workflow is triggered and nothing is reranked '''
+        self._report_progress("Searching definitions and sections by keyword ...")
+        return (self.corpus_index.get_no_workflow(),
+                self.corpus_index.get_lexical_definitions(user_question),
+                self.corpus_index.get_lexical_sections(user_question))
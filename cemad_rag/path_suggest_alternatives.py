@@ -1,10 +1,11 @@
 import logging
 from regulations_rag.data_classes import AlternativeQuestionResponse, NoAnswerResponse, NoAnswerClassification
-from regulations_rag.embeddings import get_ada_embedding, EmbeddingParameters
+from regulations_rag.embeddings import EmbeddingParameters
 from regulations_rag.rerank import RerankAlgos
 
 from regulations_rag.corpus_chat_tools import ChatParameters
 from cemad_rag.cemad_corpus_index import CEMADCorpusIndex
+from cemad_rag.pipeline_config import PipelineConfig
 
 
 logger = logging.getLogger(__name__)
@@ -16,8 +17,9 @@ logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
 
 class PathSuggestAlternatives:
 
-    def __init__(self, chat_parameters: ChatParameters, corpus_index: CEMADCorpusIndex, embedding_parameters: EmbeddingParameters, rerank_algo: RerankAlgos):
+    def __init__(self, chat_parameters: ChatParameters, corpus_index: CEMADCorpusIndex, embedding_parameters: EmbeddingParameters, rerank_algo: RerankAlgos, pipeline_config: PipelineConfig = None):
         self.chat_parameters = chat_parameters
+        self.pipeline_config = pipeline_config
         self.corpus_index = corpus_index
         self.embedding_parameters = embedding_parameters
         self.rerank_algo = rerank_algo
@@ -29,6 +31,14 @@ class PathSuggestAlternatives:
             stripped_message_history.append(stripped_message)
         return stripped_message_history
 
+    def get_embeddings(self, texts: list):
+        ''' The embeddings of all the texts from a single request, in the same order as texts '''
+        openai_client = self.pipeline_config.openai_client if self.pipeline_config is not None else self.chat_parameters.openai_client
+        response = openai_client.embeddings.create(input = [text.replace("\n", " ") for text in texts],
+                                                   model = self.embedding_parameters.model,
+                                                   dimensions = self.embedding_parameters.dimensions)
+        return [data.embedding for data in sorted(response.data, key = lambda data: data.index)]
+
     def suggest_alternative_questions(self, message_history: list, current_user_message: dict):
         logger.log(ANALYSIS_LEVEL, "Suggesting alternative questions")
 
@@ -59,16 +69,16 @@ class PathSuggestAlternatives:
             list_of_alternative_questions = [substr.strip() for substr in initial_response.split('|') if substr]
 
         alternative_questions_with_search_results = []
-        for question in list_of_alternative_questions:
-            question_embedding = get_ada_embedding(self.chat_parameters.openai_client, question, self.embedding_parameters.model, self.embedding_parameters.dimensions)        
-            relevant_definitions = self.corpus_index.get_relevant_definitions(user_content = question, user_content_embedding = question_embedding, threshold = self.embedding_parameters.threshold_definitions)
-            relevant_sections = self.corpus_index.get_relevant_sections(user_content = question, 
-                                                                user_content_embedding = question_embedding, 
-                                                                threshold = self.embedding_parameters.threshold, 
-                                                                rerank_algo = self.rerank_algo)            
-            number_of_hits = len(relevant_definitions) + len(relevant_sections) 
-            if number_of_hits > 0:
-                alternative_questions_with_search_results.append([question, number_of_hits])
+        if list_of_alternative_questions:
+            # One embedding request and one matrix-matrix search for all the alternatives. Only the number of hits is
+            # needed to rank the alternatives so there is no rerank here
+            question_embeddings = self.get_embeddings(list_of_alternative_questions)
+            hits = self.corpus_index.count_relevant_hits(question_embeddings,
+                                                         threshold_definitions = self.embedding_parameters.threshold_definitions,
+                                                         threshold = self.embedding_parameters.threshold)
+            for question, number_of_hits in zip(list_of_alternative_questions, hits):
+                if number_of_hits > 0:
+                    alternative_questions_with_search_results.append([question, int(number_of_hits)])
 
         # Sort alternative_questions_with_search_results by descending number_of_hits
         alternative_questions_with_search_results.sort(key=lambda x: x[1], reverse=True)
@@ -0,0 +1,96 @@
+import contextvars
+import logging
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from regulations_rag.rerank import RerankAlgos
+
+logger = logging.getLogger(__name__)
+DEV_LEVEL = 15
+ANALYSIS_LEVEL = 25
+logging.addLevelName(DEV_LEVEL, 'DEV')
+logging.addLevelName(ANALYSIS_LEVEL, 'ANALYSIS')
+
+
+@dataclass(frozen = True)
+class PipelineConfig:
+    """
+    The settings of the retrieval and answer pipeline that are shared by every session in the process. It is frozen
+    so it can be passed to any number of sessions running in parallel threads without being changed underneath
+    them. Build a new one (dataclasses.replace) to change a setting. Sessions may use different configurations.
+    """
+    openai_client: object
+    chat_model: str
+    user_type: str
+    corpus_description: str
+    final_token_cap: int = 5000
+
+    def llm_rerank_params(self):
+        ''' A new dict of the parameters for RerankAlgos.LLM '''
+        return {"openai_client": self.openai_client,
+                "model_to_use": self.chat_model,
+                "user_type": self.user_type,
+                "corpus_description": self.corpus_description,
+                "final_token_cap": self.final_token_cap}
+
+
+# The parameters RerankAlgos.LLM.params resolves to in the current context. See use_pipeline_config
+_context_params = contextvars.ContextVar("llm_rerank_params", default = None)
+_install_lock = threading.Lock()
+
+
+class LLMRerankParams(MutableMapping):
+    """
+    Installed as RerankAlgos.LLM.params. regulations_rag reads the settings for the LLM reranker from there, and it is
+    global to the process, so this resolves every read and write to the dict set up by use_pipeline_config for the
+    current context. A session therefore always reranks with its own PipelineConfig, and a write (by
+    regulations_rag or anything else) only changes the current context's copy, never another session's parameters.
+    Outside use_pipeline_config (e.g. on another thread) there are no parameters and a KeyError is raised rather
+    than reranking with another session's client and model.
+    """
+    def _params(self):
+        params = _context_params.get()
+        if params is None:
+            raise KeyError("RerankAlgos.LLM used outside use_pipeline_config")
+        return params
+
+    def __getitem__(self, key):
+        return self._params()[key]
+
+    def __setitem__(self, key, value):
+        self._params()[key] = value
+
+    def __delitem__(self, key):
+        del self._params()[key]
+
+    def __iter__(self):
+        return iter(self._params())
+
+    def __len__(self):
+        return len(self._params())
+
+
+def install_llm_rerank_params():
+    ''' Installs LLMRerankParams as RerankAlgos.LLM.params, once per process '''
+    with _install_lock:
+        if not isinstance(RerankAlgos.LLM.params, LLMRerankParams):
+            RerankAlgos.LLM.params = LLMRerankParams()
+            logger.log(DEV_LEVEL, "Installed the LLM rerank parameters")
+
+
+@contextmanager
+def use_pipeline_config(pipeline_config):
+    """
+    RerankAlgos.LLM.params resolves to the parameters of pipeline_config inside the block (in this thread). Does
+    nothing if pipeline_config is None. Other threads do not inherit it
+    """
+    if pipeline_config is None:
+        yield
+        return
+    token = _context_params.set(pipeline_config.llm_rerank_params())
+    try:
+        yield
+    finally:
+        _context_params.reset(token)
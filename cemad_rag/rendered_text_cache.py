@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+
+class RenderedTextCache:
+    """
+    A size bounded, thread safe LRU cache of rendered section text.
+
+    There is one instance per process (rendered_text_cache below) so every Streamlit session shares the same
+    rendered sections. Keys start with the corpus version so text rendered from an older version of the
+    documents is never returned; those entries simply age out of the cache.
+    """
+    def __init__(self, max_size = 8192):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # Render outside the lock so one slow section does not block the other sessions
+        text = render()
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                    "size": len(self._entries),
+                    "max_size": self.max_size}
+
+
+rendered_text_cache = RenderedTextCache()
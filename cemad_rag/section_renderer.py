@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+
+class SectionRenderer:
+    """
+    Builds the text for a section (with the conditions and qualifiers from its parents) out of lines that are
+    formatted once, when the document is loaded.
+
+    Each row of document_as_df is formatted twice: once with plain spaces for the indent and once with '&nbsp;'
+    for markdown. Rendering a section then only slices these arrays, using the row positions from the
+    SectionStore, and joins them with str.join.
+    """
+    def __init__(self, document_as_df, section_store):
+        self.section_store = section_store
+
+        reference = document_as_df['reference'].fillna('').astype(str)
+        text = document_as_df['text']
+        line_body = reference.where(text.isna(), reference + " " + text.fillna('').astype(str))
+        line_body = line_body.where(reference != '', text.fillna('').astype(str))
+        number_of_spaces = document_as_df['indent'].to_numpy() * 4
+
+        self.plain_lines = self._indent_lines(line_body, number_of_spaces, " ")
+        self.markdown_lines = self._indent_lines(line_body, number_of_spaces, "&nbsp;")
+
+    @staticmethod
+    def _indent_lines(line_body, number_of_spaces, space):
+        indent = pd.Series(space, index=line_body.index).str.repeat(number_of_spaces)
+        return (indent + line_body).to_numpy(dtype=object)
+
+    def render(self, section_reference, add_markdown_decorators = True):
+        ''' Returns None if there are no rows for section_reference '''
+        if add_markdown_decorators:
+            lines = self.markdown_lines
+            line_end = "\n\n"
+        else:
+            lines = self.plain_lines
+            line_end = "\n"
+
+        terminal_rows = self.section_store.get_subtree_rows(section_reference)
+        if len(terminal_rows) == 0:
+            return None
+        text = line_end.join(lines[terminal_rows])
+        if section_reference == '': # i.e. there is no parent
+            return text
+
+        # Parent rows before the section are conditions on it, parent rows after it are qualifiers
+        first_terminal_row = terminal_rows[0]
+        conditions = []
+        qualifiers = []
+        for parent_reference in self.section_store.get_ancestors(section_reference):
+            parent_rows = self.section_store.get_rows(parent_reference)
+            split = np.searchsorted(parent_rows, first_terminal_row)
+            if split > 0:
+                conditions.append(line_end.join(lines[parent_rows[:split]]))
+            if split < len(parent_rows):
+                qualifiers.append(line_end.join(lines[parent_rows[split:]]))
+
+        # conditions run from the root down to the section, qualifiers from the section up to the root
+        conditions.reverse()
+        return line_end.join(conditions + [text] + qualifiers)
@@ -0,0 +1,85 @@
+import functools
+from bisect import bisect_left
+
+import numpy as np
+
+
+class SectionStore:
+    """
+    Row lookups by section_reference for one document, built once when the document is loaded.
+
+    Rows are identified by their position in document_as_df (i.e. manual order). The distinct references are
+    kept in a sorted list so that every reference starting with a given prefix can be found with two bisects,
+    and the rows for a single reference with one dictionary lookup. This replaces the full-table
+    'str.startswith' and equality scans that get_text and get_heading used to do on every call.
+
+    The subtree rows are memoized, for at most MEMOIZED_SUBTREES references, because get_text is called with any
+    string (e.g. free text from the Section Lookup page) on a store shared by every session.
+    """
+    MEMOIZED_SUBTREES = 1024
+
+    def __init__(self, document_as_df, reference_checker):
+        self.reference_checker = reference_checker
+        self.number_of_rows = len(document_as_df)
+
+        rows_by_reference = {}
+        for position, reference in enumerate(document_as_df['section_reference'].to_list()):
+            rows_by_reference.setdefault(reference, []).append(position)
+        self.rows_by_reference = {reference: np.array(rows, dtype=np.intp) for reference, rows in rows_by_reference.items()}
+        self.sorted_references = sorted(self.rows_by_reference)
+
+        self._get_subtree_rows = functools.lru_cache(maxsize = self.MEMOIZED_SUBTREES)(self._find_subtree_rows)
+
+        # The heading text for each reference that has a heading row, formatted as it appears in a heading chain
+        self.headings = {}
+        self.references_with_multiple_headings = set()
+        heading_df = document_as_df.loc[document_as_df['heading'] == True]
+        for reference, heading_reference, heading_text in zip(heading_df['section_reference'], heading_df['reference'], heading_df['text']):
+            if reference in self.headings:
+                self.references_with_multiple_headings.add(reference)
+            self.headings[reference] = heading_reference + " " + heading_text + "."
+
+    def contains(self, section_reference):
+        return section_reference in self.rows_by_reference
+
+    def get_rows(self, section_reference):
+        ''' Positions of the rows whose section_reference is exactly section_reference, in manual order '''
+        return self.rows_by_reference.get(section_reference, np.empty(0, dtype=np.intp))
+
+    def get_subtree_rows(self, section_reference):
+        '''
+            Positions of the rows whose section_reference starts with section_reference, in manual order. Note this
+            is a string prefix match (so 'B.1' also picks up 'B.10') to stay consistent with the original
+            document_as_df['section_reference'].str.startswith() filter
+        '''
+        return self._get_subtree_rows(section_reference)
+
+    def _find_subtree_rows(self, section_reference):
+        if section_reference == '':
+            return np.arange(self.number_of_rows, dtype=np.intp)
+        start = bisect_left(self.sorted_references, section_reference)
+        # every string with this prefix sorts before the prefix followed by the largest code point
+        end = bisect_left(self.sorted_references, section_reference + '\U0010ffff', lo=start)
+        matching_references = self.sorted_references[start:end]
+        if len(matching_references) == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate([self.rows_by_reference[reference] for reference in matching_references]))
+
+    def get_ancestors(self, section_reference):
+        ''' The chain of parent references, starting with the immediate parent and ending at the root of the reference '''
+        return self.reference_checker.get_ancestors(section_reference)
+
+    def get_heading_chain(self, section_reference):
+        ''' The headings of section_reference and all its ancestors, starting at the root. Does not check that section_reference is valid '''
+        chain = []
+        for reference in (section_reference,) + self.get_ancestors(section_reference):
+            if reference in self.references_with_multiple_headings:
+                return f"There was more than one heading for the section reference {section_reference}"
+            if reference in self.headings:
+                chain.append(self.headings[reference])
+        chain.reverse()
+        return " ".join(chain)
+
+    def build_heading_chains(self):
+        ''' The heading chain for every valid section_reference in the document '''
+        return {reference: self.get_heading_chain(reference) for reference in self.sorted_references if self.reference_checker.is_valid(reference)}
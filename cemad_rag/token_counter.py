@@ -0,0 +1,29 @@
+import threading
+
+import numpy as np
+import tiktoken
+
+
+class TokenCounter:
+    """
+    Counts tokens with the tiktoken encoding of a chat model. The encoding is only loaded the first time it is needed
+    because a snapshot of the index already has the token counts.
+    """
+    def __init__(self, model = "gpt-4o"):
+        self.model = model
+        self._encoding = None
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        with self._lock:
+            if self._encoding is None:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            return self._encoding
+
+    def count(self, text):
+        return len(self._get_encoding().encode_ordinary(str(text)))
+
+    def count_all(self, texts):
+        ''' The token count of each text as an integer array. The texts are encoded in parallel by tiktoken '''
+        texts = [str(text) for text in texts]
+        return np.array([len(tokens) for tokens in self._get_encoding().encode_ordinary_batch(texts)], dtype = np.int32)
@@ -1,6 +1,7 @@
 import logging
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient
 import platform
 import bcrypt
 from dotenv import load_dotenv
@@ -9,7 +10,9 @@ import streamlit as st
 
 # from azure.identity import DefaultAzureCredential
 # from azure.keyvault.secrets import SecretClient
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, BlobType, ContentSettings
 
 from regulations_rag.rerank import RerankAlgos
 from regulations_rag.corpus_chat import ChatParameters
@@ -17,6 +20,10 @@ from regulations_rag.embeddings import  EmbeddingParameters
 
 from cemad_rag.cemad_corpus_index import CEMADCorpusIndex
 from cemad_rag.corpus_chat_cemad import CorpusChatCEMAD
+from cemad_rag.embedding_cache import EmbeddingCache, CachedEmbeddingsClient
+from cemad_rag.answer_cache import AnswerCache
+from cemad_rag.pipeline_config import PipelineConfig
+from blob_log_shipper import BlobLogShipper, GlobalLogUploader, RotatingAppendBlob
 
 DEV_LEVEL = 15
 ANALYSIS_LEVEL = 25
@@ -47,16 +54,28 @@ def _get_blog_container():
 
     return container_client
 
+def _open_append_blob(container_client, blob_name):
+    ''' (blob_client, number of committed blocks) for the append blob, which is created if it does not exist. None if it is not an append blob '''
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        properties = blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        try:
+            # IfMissing so a blob that another instance of the app has just created is not replaced
+            blob_client.create_append_blob(content_settings=ContentSettings(content_type='text/plain'), match_condition=MatchConditions.IfMissing)
+            return blob_client, 0
+        except ResourceExistsError:
+            properties = blob_client.get_blob_properties()
+    if properties.blob_type != BlobType.APPENDBLOB:
+        return None
+    return blob_client, properties.append_blob_committed_block_count
+
 @st.cache_resource
 def _get_blob_for_global_logging(filename):
     container_client = _get_blog_container()
-    blob_client = container_client.get_blob_client(filename)
-    
-    blob_exists = blob_client.exists()
-    if not blob_exists:
-        with open(st.session_state['global_logging_file_name'], "rb") as temp_file:
-            container_client.upload_blob(name=filename, data=temp_file, content_settings=ContentSettings(content_type='text/plain'))
-    return blob_client
+    # The global log is appended to (see GlobalLogUploader). Older versions uploaded it as a block blob, which is
+    # kept as it is: the log continues in the next blob name (see RotatingAppendBlob), as it does when a blob is full
+    return RotatingAppendBlob(lambda blob_name: _open_append_blob(container_client, blob_name), filename)
 
 
 # summary data for analysis is sent to individual files per session
@@ -197,41 +216,101 @@ def setup_log_storage(filename):
 @st.cache_resource
 def load_cemad_corpus_index(key):
     logger.log(ANALYSIS_LEVEL, f"*** Loading cemad corpis index. This should only happen once")
-    return CEMADCorpusIndex(key)
+    ann_number_of_probes = os.getenv("ANN_NUMBER_OF_PROBES")
+    corpus_index = CEMADCorpusIndex(key,
+                                    snapshot_folder = os.getenv("INDEX_SNAPSHOT_FOLDER"),
+                                    embedding_precision = os.getenv("EMBEDDING_PRECISION", "float32"),
+                                    ann_number_of_probes = int(ann_number_of_probes) if ann_number_of_probes else None,
+                                    lexical_search = os.getenv("LEXICAL_SEARCH", "false").lower() == "true",
+                                    hybrid_search = os.getenv("HYBRID_SEARCH", "false").lower() == "true")
+    # Optionally pre-render every section into the process wide text cache so the first users don't pay for it
+    if os.getenv("WARM_TEXT_CACHE", "false").lower() == "true":
+        corpus_index.corpus.warm_text_cache()
+    return corpus_index
+
+# One embedding cache for the process so a question embedded in one session is reused by all the others
+@st.cache_resource
+def load_embedding_cache():
+    return EmbeddingCache(database_path = os.getenv("EMBEDDING_CACHE_DATABASE"),
+                          max_database_size = int(os.getenv("EMBEDDING_CACHE_DATABASE_SIZE", "20000")))
+
+# One answer cache for the process so an FAQ answered for one user is reused for all the others. None if ANSWER_CACHE_SIZE is 0
+@st.cache_resource
+def load_answer_cache():
+    max_size = int(os.getenv("ANSWER_CACHE_SIZE", "0"))
+    if max_size <= 0:
+        return None
+    return AnswerCache(max_size = max_size,
+                       time_to_live = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600))),
+                       database_path = os.getenv("ANSWER_CACHE_DATABASE"))
+
+# One connection pooled client per api key for the process. It is shared by the chat, the reranker,
+# PathSuggestAlternatives and the BOP page so the sessions reuse the keep-alive connections and the number of
+# concurrent requests to OpenAI is capped at OPENAI_MAX_CONNECTIONS (further requests wait for a connection)
+@st.cache_resource
+def load_openai_client(api_key):
+    max_connections = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+    timeout = httpx.Timeout(float(os.getenv("OPENAI_TIMEOUT", "60")), connect = 5.0)
+    http_client = DefaultHttpxClient(limits = httpx.Limits(max_connections = max_connections, max_keepalive_connections = max_connections),
+                                     timeout = timeout)
+    openai_client = OpenAI(api_key = api_key, http_client = http_client, timeout = timeout, max_retries = 2)
+    return CachedEmbeddingsClient(openai_client, load_embedding_cache())
+
+# One ChatParameters per api key for the process. ChatParameters builds its own OpenAI client, so building it for
+# each session would create a client (and connection pool) per session. Here that client is replaced, once, by the
+# shared one. The sessions only read it
+@st.cache_resource
+def load_chat_parameters(api_key, chat_model):
+    chat_parameters = ChatParameters(chat_model = chat_model, api_key = api_key, temperature = 0, max_tokens = 500, token_limit_when_truncating_message_queue = 3500)
+    chat_parameters.openai_client = load_openai_client(api_key)
+    return chat_parameters
 
 def load_data():
     with st.spinner(text="Loading the excon documents and index - hang tight! This should take 5 seconds."):
         embedding_parameters = EmbeddingParameters("text-embedding-3-large", 1024)
         corpus_index = load_cemad_corpus_index(st.session_state['corpus_decryption_key'])
         model_to_use =  "gpt-4o"
-        chat_parameters = ChatParameters(chat_model = model_to_use, api_key=st.session_state['openai_key'], temperature = 0, max_tokens = 500, token_limit_when_truncating_message_queue = 3500)
-
+        chat_parameters = load_chat_parameters(st.session_state['openai_key'], model_to_use)
+        # Identical for every session with the same api key. CorpusChatCEMAD uses it for the RerankAlgos.LLM parameters of its turns
+        pipeline_config = PipelineConfig(openai_client = load_openai_client(st.session_state['openai_key']),
+                                         chat_model = model_to_use,
+                                         user_type = corpus_index.user_type,
+                                         corpus_description = corpus_index.corpus_description,
+                                         final_token_cap = 5000) # can go large with the new models
         rerank_algo = RerankAlgos.LLM
-        rerank_algo.params["openai_client"] = chat_parameters.openai_client
-        rerank_algo.params["model_to_use"] = model_to_use
-        rerank_algo.params["user_type"] = corpus_index.user_type
-        rerank_algo.params["corpus_description"] = corpus_index.corpus_description
-        rerank_algo.params["final_token_cap"] = 5000 # can go large with the new models
 
-        
         chat = CorpusChatCEMAD(
                           embedding_parameters = embedding_parameters, 
                           chat_parameters = chat_parameters, 
                           corpus_index = corpus_index,
                           rerank_algo = rerank_algo,   
-                          user_name_for_logging=st.session_state["user_id"])
+                          user_name_for_logging=st.session_state["user_id"],
+                          pipeline_config = pipeline_config,
+                          lexical_only = os.getenv("LEXICAL_ONLY", "false").lower() == "true",
+                          embedding_timeout = float(os.getenv("EMBEDDING_TIMEOUT")) if os.getenv("EMBEDDING_TIMEOUT") else None,
+                          cross_reference_token_budget = int(os.getenv("CROSS_REFERENCE_TOKEN_BUDGET", "0")),
+                          answer_cache = load_answer_cache())
 
         return chat
 
 
 
+# One background shipper for the process so writing a session log line never waits for Azure
+@st.cache_resource
+def load_blob_log_shipper():
+    return BlobLogShipper(batch_interval = float(os.getenv("BLOB_LOG_BATCH_INTERVAL", "2")))
+
 def write_session_data_to_blob(text):
     if 'service_provider' in st.session_state and st.session_state['service_provider'] == 'azure':
         # Session log for user
-        st.session_state['blob_client_for_session_data'].append_block(text + "\n")
+        load_blob_log_shipper().write(st.session_state['blob_client_for_session_data'], text + "\n")
+
+# One uploader for the process because it remembers how much of the log file has already been uploaded
+@st.cache_resource
+def load_global_log_uploader(log_file_name, blob_name):
+    return GlobalLogUploader(log_file_name, _get_blob_for_global_logging(blob_name), load_blob_log_shipper())
 
 def write_global_data_to_blob():
     if 'service_provider' in st.session_state and st.session_state['service_provider'] == 'azure':
-        with open(st.session_state['global_logging_file_name'], "r") as temp_file:
-            content = temp_file.read()
-        st.session_state['blob_client_for_global_data'].upload_blob(data=content, overwrite=True)
+        # Only appends what was logged since the last upload, on the shipper's thread
+        load_global_log_uploader(st.session_state['global_logging_file_name'], st.session_state['blob_name_for_global_logs']).upload()
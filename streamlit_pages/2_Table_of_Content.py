@@ -1,13 +1,6 @@
-import os
-import importlib.util
-import inspect
-
-
 import streamlit as st
 
 import streamlit_antd_components as sac
-from anytree import Node, PreOrderIter
-from regulations_rag.regulation_table_of_content import StandardTableOfContent
 
 
 # If there is page reload, switch to a page where init_session was called.
@@ -24,89 +17,61 @@ with st.sidebar:
     st.markdown(f'The "User Queries" document provides additional or clarifying information. Is uses an index similar to that of the manual, but with sections like "Z.1" that are not part of CEMAD itself, to avoid confusion.')
     st.markdown('**Note:** I have not included all the tables in this Table of Content.')
 
-def load_class_from_file(filepath):
-    spec = importlib.util.spec_from_file_location("module.name", filepath)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    
-    # Find the class that is not abstract
-    for name, obj in inspect.getmembers(module, inspect.isclass):
-        if obj.__module__ == module.__name__ and not inspect.isabstract(obj):
-            return obj
-    raise ValueError(f"No suitable class found in {filepath}")
-
-
-# Function to add a property to every node in the tree
-def add_property_to_all_nodes(root, property_name, property_value):
-    for node in PreOrderIter(root):
-        setattr(node, property_name, property_value)
-
-
-def anytree_to_treeitem(node):
-    if not hasattr(node, 'full_node_name') or node.full_node_name == '':
-        return sac.TreeItem(
-        label= f'{node.name}',
-        children=[anytree_to_treeitem(child) for child in node.children] if node.children else None
-        )
-    else: 
-        return sac.TreeItem(
-            label= f'{node.full_node_name} {node.heading_text}',
-            children=[anytree_to_treeitem(child) for child in node.children] if node.children else None
-        )
-
+class CombinedTableOfContent:
+    """
+    The Table of Content of all the documents, built once and shared by every session (see load_tree_data).
+
+    sac.tree returns the pre-order index of the selected item so the nodes are stored in a list in the same order,
+    as (document, full_node_name, heading_text), with None for the items that are not sections (e.g. "Corpus").
+    Looking up the selection is then a list index instead of a walk of the tree.
+
+    tocs is a dictionary of document_key -> the document's table of content. The tables of content belong to the
+    corpus so they are only read, never changed.
+    """
+    def __init__(self, root_name, tocs):
+        self.nodes = [None]
+        children = [self._add_node(document_key, toc.root) for document_key, toc in tocs.items()]
+        self.sac_tree = sac.TreeItem(label = root_name, children = children if children else None)
+
+    def _add_node(self, document_key, node):
+        # the node is added before its children so self.nodes is in the same (pre) order as the sac.tree indices
+        if not hasattr(node, 'full_node_name') or node.full_node_name == '':
+            label = f'{node.name}'
+            self.nodes.append(None)
+        else:
+            label = f'{node.full_node_name} {node.heading_text}'
+            self.nodes.append((document_key, node.full_node_name, node.heading_text))
+        children = [self._add_node(document_key, child) for child in node.children]
+        return sac.TreeItem(label = label, children = children if children else None)
+
+    def get_node(self, index):
+        ''' (document, full_node_name, heading_text) for the item at the sac.tree index, or None if it is not a section '''
+        if index is None or not 0 <= index < len(self.nodes):
+            return None
+        return self.nodes[index]
 
 
 @st.cache_resource
-def load_tree_data():
-    date_ordered_list_of_documents = ['cemad.py', 'cemad_user_queries.py']
-
-
-    input_folder = './cemad_rag/documents/'
-
-    combined_toc = Node("Corpus")
-
-    for filename in date_ordered_list_of_documents:
-        filepath = os.path.join(input_folder, filename)
-        Class = load_class_from_file(filepath)
-        instance = Class()
-        toc = instance.get_toc()
-        class_name = Class.__name__
-        add_property_to_all_nodes(toc.root, 'document', class_name)
-        toc.root.parent = combined_toc
-
-    sac_tree = anytree_to_treeitem(combined_toc.root)
-    # Display the tree using sac.tree
-    return combined_toc, sac_tree
-
+def load_tree_data(_corpus):
+    ''' Uses the tables of content of the documents already loaded in the (process wide) corpus '''
+    date_ordered_list_of_documents = ['CEMAD', 'CEMAD_User_Queries']
+    return CombinedTableOfContent("Corpus", {document_key: _corpus.get_toc(document_key) for document_key in date_ordered_list_of_documents})
 
-def find_nth_item(tree_item, n):
-    def traverse_tree(item, count):
-        if count[0] == n:
-            return item
-        count[0] += 1
-        for child in item.children:
-            result = traverse_tree(child, count)
-            if result:
-                return result
-        return None
-    return traverse_tree(tree_item, [0])
 
 def get_text_for_node(node_number):
-    combined_toc = st.session_state['tree_data']
-    anytree_node = find_nth_item(combined_toc, node_number)
-    
-    if hasattr(find_nth_item(combined_toc, node_number), "full_node_name"):
-        node = find_nth_item(combined_toc, node_number)
-        return st.session_state['chat'].corpus.get_document(node.document).get_text(node.full_node_name, add_markdown_decorators = True, add_headings = True, section_only = False)
-    else:
+    node = st.session_state['tree_data'].get_node(node_number)
+    if node is None:
         return "No selection to display yet"
+    document, full_node_name, _ = node
+    # through the corpus so the text comes from the process wide rendered text cache
+    return st.session_state['chat'].corpus.get_text(document, full_node_name, add_markdown_decorators = True, add_headings = True, section_only = False)
 
 
 
 if 'tree' not in st.session_state:    
-    anytree_toc, sac_tree_data = load_tree_data()
-    st.session_state['tree'] = sac_tree_data
-    st.session_state['tree_data'] = anytree_toc
+    table_of_content = load_tree_data(st.session_state['chat'].corpus)
+    st.session_state['tree'] = table_of_content.sac_tree
+    st.session_state['tree_data'] = table_of_content
 
 #selected = sac.tree(items=[st.session_state['tree']], label='Included Documents', index=0, size='md', return_index=True)
 selected = sac.tree(items=[st.session_state['tree']], label='### **Included Documents**', size='md', return_index=True)
@@ -1,8 +1,10 @@
+import os
 import streamlit as st
-from regulations_rag.embeddings import get_ada_embedding, get_closest_nodes
+from regulations_rag.embeddings import get_ada_embedding
 import pandas as pd
 import json
 from streamlit_common import write_session_data_to_blob
+from cemad_rag.embedding_matrix import EmbeddingMatrix
 
 st.title('Search BOP Codes')
 
@@ -12,7 +14,7 @@ def load_bop_codes_data():
     with st.spinner(text="Loading the BOP codes - hang tight! This should take a few seconds."):
         path_to_bop_codes_as_parquet_file = "./inputs/index/bopcodes.parquet"
         df = pd.read_parquet(path_to_bop_codes_as_parquet_file, engine="pyarrow")
-        return df
+        return EmbeddingMatrix(df, "embedding", precision = os.getenv("EMBEDDING_PRECISION", "float32"))
 
 if 'bop_codes' not in st.session_state:
     st.session_state['bop_codes'] = load_bop_codes_data()
@@ -54,8 +56,7 @@ if st.session_state['bop_lookup'][-1]["role"] != "assistant":
             dimensions=st.session_state['chat'].embedding_parameters.dimensions
             threshold = st.session_state['chat'].embedding_parameters.threshold
             question_embedding = get_ada_embedding(openai_client=openai_client, text=prompt, model=model, dimensions=dimensions)
-            closest_nodes = get_closest_nodes(st.session_state['bop_codes'], "embedding", question_embedding, threshold = 1.0)
-            closest_nodes = closest_nodes.nsmallest(16, 'cosine_distance') 
+            closest_nodes = st.session_state['bop_codes'].get_closest_nodes(question_embedding, threshold = 1.0, top_k = 16)
 
     relevant_columns = ["category", "sub-category", "category description", "inward or outward"]
     df = closest_nodes[relevant_columns]
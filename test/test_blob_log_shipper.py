@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+
+import pytest
+
+from blob_log_shipper import BlobLogShipper, GlobalLogUploader, RotatingAppendBlob
+
+
+class FakeAppendBlobClient:
+    """ Records the blocks appended to it. The first `failures` appends raise """
+    def __init__(self, failures = 0):
+        self.blocks = []
+        self.attempts = 0
+        self.failures = failures
+        self._lock = threading.Lock()
+
+    def append_block(self, data):
+        with self._lock:
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise ConnectionError("Azure is down")
+            self.blocks.append(data)
+
+    @property
+    def content(self):
+        return b"".join(self.blocks)
+
+
+@pytest.fixture
+def shippers():
+    created = []
+    def create_shipper(**kwargs):
+        shipper = BlobLogShipper(**kwargs)
+        created.append(shipper)
+        return shipper
+    yield create_shipper
+    for shipper in created:
+        shipper.close()
+
+
+def test_lines_written_together_are_appended_in_one_block(shippers):
+    shipper = shippers(batch_interval = 0.5)
+    blob_client = FakeAppendBlobClient()
+    for i in range(5):
+        shipper.write(blob_client, f"line {i}\n")
+    assert shipper.flush(timeout = 5)
+    assert blob_client.blocks == [b"line 0\nline 1\nline 2\nline 3\nline 4\n"]
+
+
+def test_blocks_are_at_most_max_block_bytes(shippers):
+    shipper = shippers(batch_interval = 0.5, max_block_bytes = 10)
+    blob_client = FakeAppendBlobClient()
+    shipper.write(blob_client, "0123456\n")
+    shipper.write(blob_client, "abc\n")
+    shipper.write(blob_client, "a line longer than a block\n")
+    assert shipper.flush(timeout = 5)
+    assert all(len(block) <= 10 for block in blob_client.blocks)
+    assert blob_client.content == b"0123456\nabc\na line longer than a block\n"
+
+
+def test_lines_for_each_blob_keep_their_order(shippers):
+    shipper = shippers(batch_interval = 0.5)
+    first_blob_client = FakeAppendBlobClient()
+    second_blob_client = FakeAppendBlobClient()
+    for i in range(3):
+        shipper.write(first_blob_client, f"first {i}\n")
+        shipper.write(second_blob_client, f"second {i}\n".encode("utf-8"))
+    assert shipper.flush(timeout = 5)
+    assert first_blob_client.content == b"first 0\nfirst 1\nfirst 2\n"
+    assert second_blob_client.content == b"second 0\nsecond 1\nsecond 2\n"
+
+
+def test_flush_does_not_wait_for_the_batch_interval(shippers):
+    shipper = shippers(batch_interval = 30)
+    blob_client = FakeAppendBlobClient()
+    shipper.write(blob_client, "line\n")
+    start = time.monotonic()
+    assert shipper.flush(timeout = 5)
+    assert time.monotonic() - start < 5
+    assert blob_client.content == b"line\n"
+
+
+def test_close_ships_what_is_queued():
+    shipper = BlobLogShipper(batch_interval = 30)
+    blob_client = FakeAppendBlobClient()
+    shipper.write(blob_client, "line\n")
+    shipper.close()
+    assert blob_client.content == b"line\n"
+
+
+def test_submitted_function_runs_after_the_lines_queued_before_it(shippers):
+    shipper = shippers(batch_interval = 0.5)
+    blob_client = FakeAppendBlobClient()
+    content_when_run = []
+    shipper.write(blob_client, "line\n")
+    assert shipper.submit(lambda: content_when_run.append(blob_client.content))
+    assert shipper.flush(timeout = 5)
+    assert content_when_run == [b"line\n"]
+
+
+def test_failed_append_is_retried(shippers):
+    shipper = shippers(batch_interval = 0.1, max_retries = 3, retry_delay = 0.01)
+    blob_client = FakeAppendBlobClient(failures = 2)
+    shipper.write(blob_client, "line\n")
+    assert shipper.flush(timeout = 5)
+    assert blob_client.attempts == 3
+    assert blob_client.blocks == [b"line\n"]
+    assert shipper.failed_blocks == 0
+
+
+def test_block_is_dropped_after_max_retries(shippers):
+    shipper = shippers(batch_interval = 0.1, max_retries = 2, retry_delay = 0.01)
+    blob_client = FakeAppendBlobClient(failures = 100)
+    shipper.write(blob_client, "line\n")
+    assert shipper.flush(timeout = 5)
+    assert blob_client.attempts == 3
+    assert blob_client.blocks == []
+    assert shipper.failed_blocks == 1
+
+
+def test_lines_are_dropped_when_the_queue_is_full(shippers):
+    shipper = shippers(batch_interval = 0.1, max_buffered_lines = 2)
+    blocked = threading.Event()
+    # keep the worker busy so the queue fills up
+    shipper.submit(blocked.wait)
+    time.sleep(0.2)
+    blob_client = FakeAppendBlobClient()
+    for i in range(5):
+        shipper.write(blob_client, f"line {i}\n")
+    blocked.set()
+    assert shipper.flush(timeout = 5)
+    assert shipper.dropped_lines == 3
+    assert blob_client.content == b"line 0\nline 1\n"
+
+
+class FakeContainer:
+    """ The blobs in a container by name. open_blob behaves like streamlit_common._open_append_blob """
+    def __init__(self, blobs = None):
+        self.blobs = blobs or {}
+
+    def open_blob(self, blob_name):
+        if blob_name not in self.blobs:
+            self.blobs[blob_name] = FakeAppendBlobClient()
+        blob_client = self.blobs[blob_name]
+        if not isinstance(blob_client, FakeAppendBlobClient):
+            return None
+        return blob_client, len(blob_client.blocks)
+
+
+def test_rotating_append_blob_moves_to_the_next_blob_when_full():
+    container = FakeContainer()
+    blob = RotatingAppendBlob(container.open_blob, "app_log.txt", max_blocks = 2)
+    for i in range(5):
+        blob.append_block(f"{i}\n".encode("utf-8"))
+    assert {name: blob_client.content for name, blob_client in container.blobs.items()} == \
+        {"app_log.txt": b"0\n1\n", "app_log.1.txt": b"2\n3\n", "app_log.2.txt": b"4\n"}
+    assert blob.current_blob_name == "app_log.2.txt"
+
+
+def test_rotating_append_blob_keeps_a_block_blob_and_skips_full_blobs():
+    full_blob_client = FakeAppendBlobClient()
+    full_blob_client.blocks = [b"old\n", b"old\n"]
+    container = FakeContainer({"app_log.txt": "a block blob from an older version", "app_log.1.txt": full_blob_client})
+    blob = RotatingAppendBlob(container.open_blob, "app_log.txt", max_blocks = 2)
+    blob.append_block(b"new\n")
+    assert container.blobs["app_log.txt"] == "a block blob from an older version"
+    assert full_blob_client.content == b"old\nold\n"
+    assert container.blobs["app_log.2.txt"].content == b"new\n"
+
+
+def test_rotating_append_blob_reads_the_block_count_again_after_a_failure(shippers):
+    container = FakeContainer()
+    blob = RotatingAppendBlob(container.open_blob, "app_log.txt", max_blocks = 2)
+    # another instance of the app fills the blob, after which Azure rejects the append
+    container.blobs["app_log.txt"].blocks = [b"other\n", b"other\n"]
+    container.blobs["app_log.txt"].failures = 1
+    shipper = shippers(batch_interval = 0.1, retry_delay = 0.01)
+    shipper.write(blob, "line\n")
+    assert shipper.flush(timeout = 5)
+    assert container.blobs["app_log.txt"].content == b"other\nother\n"
+    assert container.blobs["app_log.1.txt"].content == b"line\n"
+    assert shipper.failed_blocks == 0
+
+
+def append_to_file(file_name, text):
+    with open(file_name, "a") as file:
+        file.write(text)
+
+
+def upload_and_flush(uploader):
+    uploader.upload()
+    assert uploader.blob_log_shipper.flush(timeout = 5)
+
+
+def test_global_log_upload_appends_only_the_new_data(shippers, tmp_path):
+    log_file_name = str(tmp_path / "app.log")
+    blob_client = FakeAppendBlobClient()
+    uploader = GlobalLogUploader(log_file_name, blob_client, shippers(batch_interval = 0.1))
+    append_to_file(log_file_name, "first\n")
+    upload_and_flush(uploader)
+    append_to_file(log_file_name, "second\n")
+    upload_and_flush(uploader)
+    upload_and_flush(uploader)
+    assert blob_client.blocks == [b"first\n", b"second\n"]
+
+
+def test_global_log_rotation_uploads_the_rest_of_the_backup_without_duplicates(shippers, tmp_path):
+    log_file_name = str(tmp_path / "app.log")
+    blob_client = FakeAppendBlobClient()
+    uploader = GlobalLogUploader(log_file_name, blob_client, shippers(batch_interval = 0.1))
+    append_to_file(log_file_name, "before the upload\n")
+    upload_and_flush(uploader)
+    append_to_file(log_file_name, "after the upload\n")
+    # what RotatingFileHandler does when the file is full
+    os.rename(log_file_name, log_file_name + ".1")
+    append_to_file(log_file_name, "after the rotation\n")
+    upload_and_flush(uploader)
+    append_to_file(log_file_name, "later\n")
+    upload_and_flush(uploader)
+    assert blob_client.content == b"before the upload\nafter the upload\nafter the rotation\nlater\n"
+
+
+def test_global_log_truncation_uploads_from_the_start(shippers, tmp_path):
+    log_file_name = str(tmp_path / "app.log")
+    blob_client = FakeAppendBlobClient()
+    uploader = GlobalLogUploader(log_file_name, blob_client, shippers(batch_interval = 0.1))
+    append_to_file(log_file_name, "a long first line\n")
+    upload_and_flush(uploader)
+    with open(log_file_name, "w") as file:
+        file.write("new\n")
+    upload_and_flush(uploader)
+    assert blob_client.content == b"a long first line\nnew\n"
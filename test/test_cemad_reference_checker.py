@@ -0,0 +1,70 @@
+import os
+
+import pandas as pd
+import pytest
+
+from regulations_rag.reference_checker import ReferenceChecker
+from cemad_rag.cemad_reference_checker import CEMADReferenceChecker
+
+DOCUMENT_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs", "documents")
+DOCUMENT_FILES = ["ad_manual.csv", "ad_manual_plus.csv"]
+
+
+def load_document(filename):
+    return pd.read_csv(os.path.join(DOCUMENT_FOLDER, filename), sep = "|", dtype = str, keep_default_na = False)
+
+
+@pytest.fixture(scope = "module")
+def checkers():
+    # The generic checker with the CEMAD patterns, i.e. what super() does. Calling super() on a CEMADReferenceChecker
+    # would send the generic code's own calls (e.g. to is_valid) back to the overrides
+    generic = ReferenceChecker(regex_list_of_indices = CEMADReferenceChecker.INDEX_PATTERNS,
+                               text_version = CEMADReferenceChecker.TEXT_PATTERN,
+                               exclusion_list = CEMADReferenceChecker.EXCLUSION_LIST)
+    return generic, CEMADReferenceChecker()
+
+
+def generic_ancestors(generic, reference):
+    ancestors = []
+    parent_reference = generic.get_parent_reference(reference)
+    while parent_reference != "":
+        ancestors.append(parent_reference)
+        parent_reference = generic.get_parent_reference(parent_reference)
+    return tuple(ancestors)
+
+
+@pytest.mark.parametrize("filename", DOCUMENT_FILES)
+def test_overrides_match_the_generic_checker_for_every_section_reference(checkers, filename):
+    generic, checker = checkers
+    references = list(dict.fromkeys(reference for reference in load_document(filename)["section_reference"] if reference != ""))
+    assert len(references) > 0
+    differences = []
+    for reference in references:
+        is_valid = generic.is_valid(reference)
+        if checker.is_valid(reference) != is_valid:
+            differences.append(("is_valid", reference))
+        if not is_valid:
+            continue
+        if checker.split_reference(reference) != generic.split_reference(reference):
+            differences.append(("split_reference", reference))
+        if checker.get_parent_reference(reference) != generic.get_parent_reference(reference):
+            differences.append(("get_parent_reference", reference))
+        if checker.get_ancestors(reference) != generic_ancestors(generic, reference):
+            differences.append(("get_ancestors", reference))
+    assert differences == []
+
+
+@pytest.mark.parametrize("filename", DOCUMENT_FILES)
+def test_extract_valid_reference_matches_the_generic_checker_for_every_text(checkers, filename):
+    generic, checker = checkers
+    texts = load_document(filename)["text"].to_list()
+    differences = [text for text in texts if checker.extract_valid_reference(text) != generic.extract_valid_reference(text)]
+    assert differences == []
+
+
+def test_memoized_answers_do_not_change(checkers):
+    _, checker = checkers
+    reference = "B.4(B)(ii)(a)"
+    assert checker.split_reference(reference) == ["B.4", "(B)", "(ii)", "(a)"]
+    assert checker.split_reference(reference) == ["B.4", "(B)", "(ii)", "(a)"]
+    assert checker.get_ancestors(reference) == ("B.4(B)(ii)", "B.4(B)", "B.4")
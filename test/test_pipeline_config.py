@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from regulations_rag.rerank import RerankAlgos
+from cemad_rag.pipeline_config import PipelineConfig, install_llm_rerank_params, use_pipeline_config
+
+NUMBER_OF_SESSIONS = 16
+TURNS_PER_SESSION = 20
+
+
+class FakeOpenAIClient:
+    """ Records the model of every chat request it is sent """
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.models = []
+        self._lock = threading.Lock()
+
+    def chat_completion(self, model):
+        with self._lock:
+            self.models.append(model)
+
+
+def fake_llm_rerank(sections):
+    ''' Reads RerankAlgos.LLM.params the way regulations_rag's LLM reranker does, with a pause in between so the sessions interleave. The number of sections kept stands in for the rerank '''
+    params = RerankAlgos.LLM.params
+    openai_client = params["openai_client"]
+    time.sleep(random.random() * 0.001)
+    openai_client.chat_completion(params["model_to_use"])
+    return sections.head(params["final_token_cap"])
+
+
+@pytest.fixture
+def pipeline_configs():
+    install_llm_rerank_params()
+    return [PipelineConfig(openai_client = FakeOpenAIClient("key_a"), chat_model = "gpt-4o", user_type = "an Authorised Dealer", corpus_description = "CEMAD", final_token_cap = 2),
+            PipelineConfig(openai_client = FakeOpenAIClient("key_b"), chat_model = "gpt-4o-mini", user_type = "an Authorised Dealer", corpus_description = "CEMAD", final_token_cap = 3)]
+
+
+def test_sessions_only_see_their_own_params_and_client(pipeline_configs):
+    sections = pd.DataFrame({"document": "CEMAD", "section_reference": ["B.1", "B.2", "B.3", "B.4"], "text": ["a", "b", "c", "d"]})
+
+    def run_session(session_number):
+        pipeline_config = pipeline_configs[session_number % len(pipeline_configs)]
+        problems = 0
+        with use_pipeline_config(pipeline_config):
+            RerankAlgos.LLM.params["session"] = session_number
+            for _ in range(TURNS_PER_SESSION):
+                problems += not fake_llm_rerank(sections).equals(sections.head(pipeline_config.final_token_cap))
+                problems += RerankAlgos.LLM.params["session"] != session_number
+                problems += RerankAlgos.LLM.params["openai_client"] is not pipeline_config.openai_client
+        return problems
+
+    with ThreadPoolExecutor(max_workers = NUMBER_OF_SESSIONS) as sessions:
+        problems = list(sessions.map(run_session, range(NUMBER_OF_SESSIONS)))
+
+    assert problems == [0] * NUMBER_OF_SESSIONS
+    turns_per_config = NUMBER_OF_SESSIONS // len(pipeline_configs) * TURNS_PER_SESSION
+    for pipeline_config in pipeline_configs:
+        assert pipeline_config.openai_client.models == [pipeline_config.chat_model] * turns_per_config
+
+
+def test_a_write_does_not_change_the_pipeline_config(pipeline_configs):
+    with use_pipeline_config(pipeline_configs[0]):
+        RerankAlgos.LLM.params["model_to_use"] = "another model"
+    with use_pipeline_config(pipeline_configs[0]):
+        assert RerankAlgos.LLM.params["model_to_use"] == "gpt-4o"
+    assert pipeline_configs[0].llm_rerank_params()["model_to_use"] == "gpt-4o"
+
+
+def test_params_raise_outside_use_pipeline_config(pipeline_configs):
+    with pytest.raises(KeyError):
+        RerankAlgos.LLM.params["openai_client"]
+    with use_pipeline_config(pipeline_configs[0]):
+        # another thread, e.g. an executor, does not inherit the session's params
+        with ThreadPoolExecutor(max_workers = 1) as executor:
+            with pytest.raises(KeyError):
+                executor.submit(fake_llm_rerank, pd.DataFrame({"section_reference": ["B.1"]})).result()
+    assert pipeline_configs[0].openai_client.models == []
+
+
+def test_nested_configs_are_restored(pipeline_configs):
+    with use_pipeline_config(pipeline_configs[0]):
+        with use_pipeline_config(pipeline_configs[1]):
+            assert RerankAlgos.LLM.params["model_to_use"] == "gpt-4o-mini"
+        assert RerankAlgos.LLM.params["model_to_use"] == "gpt-4o"
+        with use_pipeline_config(None):
+            assert RerankAlgos.LLM.params["model_to_use"] == "gpt-4o"